@@ -1,17 +1,76 @@
 import sys
+import src.bench as bench
+import src.blobs as blobs
+import src.compress as compress
+import src.daemon as daemon
+import src.db as db
+import src.download as download
 import src.fetch as f
 import src.init as init
-import src.log as log
+import src.media as media
+import src.pack as pack
+import src.refresh as refresh
+import src.writer as writer
 
 
 def main():
-    log.purge_logs()
-
     args = sys.argv[1:]
     if args and args[0] == 'init':
         init.main()
         quit()
 
+    if args and args[0] == 'dedupe':
+        db.init_db()
+        blobs.dedupe()
+        writer.stop()
+        db.close_all()
+        quit()
+
+    if args and args[0] == 'media':
+        db.init_db()
+        media.drain()
+        download.shutdown()
+        writer.stop()
+        db.close_all()
+        quit()
+
+    if args and args[0] == 'refresh':
+        db.init_db()
+        refresh.run(int(args[1]) if len(args) > 1 else None)
+        download.shutdown()
+        writer.stop()
+        db.close_all()
+        quit()
+
+    if args and args[0] == 'daemon':
+        daemon.run()
+        quit()
+
+    if args and args[0] == 'json-convert':
+        if len(args) < 2:
+            print("Usage: python main.py json-convert packed|files")
+            quit()
+        pack.convert(args[1])
+        quit()
+
+    if args and args[0] == 'compress-json':
+        db.init_db()
+        compress.migrate()
+        writer.stop()
+        db.close_all()
+        quit()
+
+    if args and args[0] == 'bench' and len(args) > 1 and args[1] == 'save':
+        bench.run_save(int(args[2]) if len(args) > 2 else None)
+        quit()
+
+    if args and args[0] == 'bench':
+        db.init_db()
+        bench.run(int(args[1]) if len(args) > 1 else None)
+        writer.stop()
+        db.close_all()
+        quit()
+
     f.fetch_all()
 
 
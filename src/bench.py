@@ -0,0 +1,216 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+from mastodon.return_types import Status
+from mastodon.types_base import try_cast_recurse
+
+import src.compress as compress
+import src.db as db
+import src.log as log
+import src.utils as utils
+import src.writer as writer
+
+from . import ACCOUNTS
+from . import PREFS
+
+
+# Microbenchmarks.
+#
+# 'bench': utils.parse_content() on the posts of the archive. If
+# BeautifulSoup is installed, the previous implementation (one BeautifulSoup
+# parse for the text, another one for the links) is measured too, and its
+# output compared with the new one.
+#
+# 'bench save': db.save_status() on synthetic statuses, in a temporary
+# database, with the connections of db.open_con() (one per thread, reused)
+# and with a new connection for every query, as LAMA used to do.
+
+BENCH_ROUNDS = 3            # the best of these is kept
+BENCH_SAVE_COUNT = 2000     # default number of statuses saved by 'bench save'
+
+
+def run(limit=None):
+    corpus = db.get_posts_content(limit)
+    if not corpus:
+        log.info("No posts in the archive.", also_print=True)
+        return
+
+    size = sum(len(html) for html in corpus)
+    log.info(f"Corpus: {len(corpus)} posts, {size / 1024:.0f} KB of HTML", also_print=True)
+
+    results, elapsed = measure(utils.parse_content, corpus)
+    log_time("parse_content", corpus, elapsed)
+
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        log.info("BeautifulSoup is not installed: no comparison with the previous implementation.", also_print=True)
+        return
+
+    def parse_content_bs4(html):
+        return strip_html_bs4(BeautifulSoup, html), extract_links_bs4(BeautifulSoup, html)
+
+    expected, elapsed_bs4 = measure(parse_content_bs4, corpus)
+    log_time("BeautifulSoup", corpus, elapsed_bs4)
+    log.info(f"Speedup: {elapsed_bs4 / elapsed:.1f}x", also_print=True)
+
+    diff = [html for html, a, b in zip(corpus, results, expected) if a != b]
+    if diff:
+        log.warn(f"⚠️ {len(diff)} post{'s' if len(diff) > 1 else ''} with a different output, e.g.: {diff[0]!r}", also_print=True)
+    else:
+        log.info("Same output for all the posts.", also_print=True)
+
+
+def measure(parse, corpus):
+    best = None
+    for _ in range(BENCH_ROUNDS):
+        start = time.perf_counter()
+        results = [parse(html) for html in corpus]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return results, best
+
+
+def log_time(name, corpus, elapsed):
+    log.info(f"  {name}: {elapsed:.2f}s, {elapsed / len(corpus) * 1e6:.0f} µs/post", also_print=True)
+
+
+def run_save(count=None):
+    count = count or BENCH_SAVE_COUNT
+    log.info(f"Saving {count} synthetic statuses (JSON files, attachments and linked posts disabled)", also_print=True)
+    statuses = synthetic_statuses(count)
+
+    elapsed = measure_save(statuses, db.open_con)
+    log.info(f"  reused connections: {elapsed:.2f}s, {count / elapsed:.0f} statuses/s", also_print=True)
+
+    elapsed_before = measure_save(statuses, open_con_per_query)
+    log.info(f"  one connection per query: {elapsed_before:.2f}s, {count / elapsed_before:.0f} statuses/s", also_print=True)
+    log.info(f"Speedup: {elapsed_before / elapsed:.1f}x", also_print=True)
+
+
+def measure_save(statuses, open_con):
+    """Seconds to save {statuses} in a new database, using {open_con}"""
+
+    prefs = dict(PREFS)
+    with tempfile.TemporaryDirectory(prefix='lama-bench-') as user_dir:
+        os.makedirs(f"{user_dir}/data")
+        PREFS.update({
+            'user_dir': user_dir,
+            'save_json': 0,
+            'download_own_attachments': 0,
+            'download_others_attachments': 0,
+            'fetch_linked_posts': 0,
+            'fetch_reply_parents': 0,
+        })
+        # the functions of db.py call open_con() through the module too
+        db.open_con = open_con
+        try:
+            db.init_db()
+            start = time.perf_counter()
+            for status in statuses:
+                db.save_status(ACCOUNTS[0], status, 'post')
+            writer.stop()
+            elapsed = time.perf_counter() - start
+        finally:
+            db.open_con = open_con_reused
+            db.close_all()
+            PREFS.clear()
+            PREFS.update(prefs)
+
+    return elapsed
+
+
+open_con_reused = db.open_con
+
+
+def open_con_per_query():
+    """db.open_con() as it was: a new connection, with the default settings"""
+
+    con = sqlite3.connect(f"{PREFS['user_dir']}/data/app.db", timeout=30)
+    con.create_function('lama_json', 1, compress.decode, deterministic=True)
+    return (con, con.cursor())
+
+
+def synthetic_statuses(count):
+    """{count} short posts of the first account, with a hashtag and a link"""
+
+    account = ACCOUNTS[0]
+    author = f"{account['instance']}/@{account['username']}"
+    template = try_cast_recurse(Status, {
+        'id': '0',
+        'uri': '',
+        'url': '',
+        'created_at': '2024-01-01T00:00:00.000Z',
+        'edited_at': None,
+        'visibility': 'public',
+        'content': '',
+        'account': {'url': author, 'uri': f"{account['instance']}/users/{account['username']}"},
+        'tags': [{'name': 'lama', 'url': f"{account['instance']}/tags/lama"}],
+        'mentions': [],
+        'media_attachments': [],
+        'reblog': None,
+        'in_reply_to_id': None,
+    })
+
+    statuses = []
+    for i in range(1, count + 1):
+        statuses.append(copy_status(template, {
+            'id': str(i),
+            'uri': f"{account['instance']}/users/{account['username']}/statuses/{i}",
+            'url': f"{author}/{i}",
+            'content': f'<p>Post number {i} <a href="{account["instance"]}/tags/lama" class="mention hashtag" rel="tag">#<span>lama</span></a></p>'
+                       f'<p><a href="https://example.org/page/{i}" rel="nofollow noopener" target="_blank">https://example.org/page/{i}</a></p>',
+        }))
+    return statuses
+
+
+def copy_status(status, values):
+    """Copy of {status} with other (string) values
+
+    Much faster than try_cast_recurse() for each status, which type-checks
+    every field: Mastodon.py keeps each field both as item and attribute.
+    """
+
+    copy = Status.__new__(Status)
+    for key, value in (dict(status) | values).items():
+        dict.__setitem__(copy, key, value)
+        object.__setattr__(copy, key, value)
+    return copy
+
+
+def strip_html_bs4(BeautifulSoup, html):
+    html = html.replace("<br>", "\n")
+    html = html.replace("<br/>", "\n")
+    html = html.replace("<br />", "\n")
+    html = html.replace("</p><p>", "\n\n")
+
+    soup = BeautifulSoup(html, 'html.parser')
+    return soup.get_text()
+
+
+def extract_links_bs4(BeautifulSoup, html):
+    soup = BeautifulSoup(html, 'html.parser')
+    links = []
+
+    for link in soup.find_all('a', href=True):
+        url = link['href']
+
+        # skip hashtags or mentions (class="mention" or class="u-url mention")
+        if 'mention' in link.get('class', []):
+            continue
+        if 'hashtag' in link.get('class', []):
+            continue
+
+        text = link.get_text(strip=True)
+        if text == url:
+            text = ''
+
+        links.append({
+            'url': url,
+            'text': text,
+            'mastodon': 1 if utils.is_link_mastodon_post(url) else 0
+        })
+
+    return links
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import shutil
+
+import src.db as db
+import src.log as log
+import src.writer as writer
+
+from . import PREFS
+
+
+# Content-addressed storage for attachments.
+#
+# Each distinct file is stored once, as data/media/_blobs/{xx}/{sha256}.{ext}.
+# The usual paths (data/media/{instance}/{author}/...) are kept, as hard links
+# to the blob (or symbolic links, or plain copies, if the file system doesn't
+# support hard links). The 'media' table maps each (post_uri, idx) to its blob.
+
+BLOB_DIR = 'media/_blobs'
+HASH_CHUNK_SIZE = 1024**2
+
+
+def get_path(blob):
+    """Full path of a blob ("{sha256}.{ext}")"""
+    return f"{PREFS['user_dir']}/data/{BLOB_DIR}/{blob[:2]}/{blob}"
+
+
+def store(path, checksum):
+    """Add a downloaded file to the blob store, and make {path} a link to it
+
+    Returns the blob name.
+    """
+
+    ext = os.path.splitext(path)[1]
+    blob = f"{checksum}{ext}"
+    blob_path = get_path(blob)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+    if not os.path.exists(blob_path):
+        try:
+            # new content: the file itself becomes the blob
+            os.link(path, blob_path)
+            return blob
+        except FileExistsError:
+            # stored in the meantime by another download
+            pass
+        except OSError:
+            shutil.copy2(path, blob_path)
+
+    if not os.path.samefile(path, blob_path):
+        link(blob_path, path)
+    return blob
+
+
+def link(blob_path, path):
+    """Replace {path} by a link to {blob_path}"""
+
+    tmp = f"{path}.lnk"
+    try:
+        os.link(blob_path, tmp)
+    except OSError:
+        try:
+            os.symlink(os.path.relpath(blob_path, os.path.dirname(path)), tmp)
+        except OSError:
+            shutil.copy2(blob_path, tmp)
+    os.replace(tmp, path)
+
+
+def hash_file(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def dedupe():
+    """Move all the attachments already downloaded into the blob store
+
+    One-off command for archives created before the blob store existed
+    (or with "media_dedupe" disabled).
+    """
+
+    log.info("Deduplicating attachments", also_print=True)
+    data_dir = f"{PREFS['user_dir']}/data"
+
+    files = 0
+    saved = 0
+    seen = set()
+
+    for post_uri, attachments in db.get_posts_attachments():
+        for idx, (path, desc) in enumerate(json.loads(attachments)):
+            full_path = f"{data_dir}/{path}"
+            if not path.startswith('media/') or not os.path.isfile(full_path):
+                # not downloaded (error message), or missing file
+                continue
+
+            blob = store(full_path, hash_file(full_path))
+            db.save_media(post_uri, idx, blob, path)
+
+            files += 1
+            if blob in seen:
+                saved += os.path.getsize(full_path)
+            seen.add(blob)
+
+            if files % 1000 == 0:
+                log.info(f"  {files} files processed", also_print=True)
+
+    writer.flush()
+
+    log.info(f"Done. {files} files processed, {files - len(seen)} duplicates ({saved / 1024**2:.1f} MB).", also_print=True)
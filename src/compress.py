@@ -0,0 +1,209 @@
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import src.db as db
+import src.log as log
+import src.writer as writer
+
+from . import PREFS
+
+
+# Compression of the 'json' column of the posts table (PREFS['json_compression']).
+#
+# A value is either TEXT (not compressed: 'none', or rows saved before the
+# option was enabled), or a BLOB whose first byte tells how it was compressed.
+# zstd uses a dictionary trained on the posts of the archive (table
+# 'json_dicts'), which works much better than plain compression on small,
+# repetitive documents such as statuses; the dictionary of a value is
+# identified by its zstd frame.
+#
+# decode() gives back the JSON of any value; it is also available in SQL,
+# with the connections of db.open_con(): lama_json(json).
+
+ZLIB = b'z'
+ZSTD = b's'
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+ZSTD_DICT_SIZE = 112 * 1024     # bytes
+ZSTD_DICT_SAMPLES = 5000        # most recent posts used to train the dictionary
+MIGRATION_CHUNK = 500           # rows per transaction
+
+_dicts = {}             # {dict_id: zstandard.ZstdCompressionDict}
+_current_dict = False   # dictionary for new values (None: no dictionary); False: not loaded yet
+_lock = threading.Lock()
+
+# zstd compressors and decompressors can't be shared between threads
+_local = threading.local()
+
+_warned = False
+
+
+def get_method():
+    global _warned
+
+    method = PREFS['json_compression']
+    if method == 'zstd' and zstandard is None:
+        if not _warned:
+            log.warn("⚠️ 'zstandard' is not installed (pip install zstandard); the 'json' column is compressed with zlib instead", also_print=True)
+            _warned = True
+        return 'zlib'
+    return method
+
+
+def encode(js):
+    """Value to store in the 'json' column for this JSON string"""
+
+    method = get_method()
+    if method == 'zstd':
+        return ZSTD + get_compressor().compress(js.encode('utf-8'))
+    if method == 'zlib':
+        return ZLIB + zlib.compress(js.encode('utf-8'), ZLIB_LEVEL)
+    return js
+
+
+def decode(value):
+    """JSON string of a value of the 'json' column, compressed or not"""
+
+    if not isinstance(value, bytes):
+        return value
+
+    tag, data = value[:1], value[1:]
+    if tag == ZLIB:
+        return zlib.decompress(data).decode('utf-8')
+    if tag == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("this post is compressed with zstd: 'zstandard' must be installed (pip install zstandard)")
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        return get_decompressor(dict_id).decompress(data).decode('utf-8')
+
+    raise ValueError(f"unknown compression for the 'json' column ({tag!r})")
+
+
+def get_current_dict():
+    global _current_dict
+
+    with _lock:
+        if _current_dict is False:
+            row = db.get_json_dict()
+            _current_dict = None
+            if row:
+                dict_id, data = row
+                _current_dict = _dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+        return _current_dict
+
+
+def get_dict(dict_id):
+    with _lock:
+        if dict_id not in _dicts:
+            row = db.get_json_dict(dict_id)
+            if row is None:
+                raise ValueError(f"zstd dictionary {dict_id} not found in table 'json_dicts'")
+            _dicts[dict_id] = zstandard.ZstdCompressionDict(row[1])
+        return _dicts[dict_id]
+
+
+def get_compressor():
+    zdict = get_current_dict()
+    compressors = getattr(_local, 'compressors', None)
+    if compressors is None:
+        compressors = _local.compressors = {}
+
+    key = zdict.dict_id() if zdict else 0
+    if key not in compressors:
+        compressors[key] = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict)
+    return compressors[key]
+
+
+def get_decompressor(dict_id):
+    decompressors = getattr(_local, 'decompressors', None)
+    if decompressors is None:
+        decompressors = _local.decompressors = {}
+
+    if dict_id not in decompressors:
+        zdict = get_dict(dict_id) if dict_id else None
+        decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=zdict)
+    return decompressors[dict_id]
+
+
+def is_current(value):
+    """Whether a value is already stored the way get_method() says"""
+
+    method = get_method()
+    if method == 'none':
+        return not isinstance(value, bytes)
+    if not isinstance(value, bytes):
+        return False
+    if method == 'zlib':
+        return value[:1] == ZLIB
+
+    zdict = get_current_dict()
+    return value[:1] == ZSTD and zstandard.get_frame_parameters(value[1:]).dict_id == (zdict.dict_id() if zdict else 0)
+
+
+def get_size(value):
+    return len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+
+
+def train_dict():
+    """Train a zstd dictionary on the most recent posts, and use it from now on"""
+
+    global _current_dict
+
+    samples = [decode(value).encode('utf-8') for value in db.get_posts_json_sample(ZSTD_DICT_SAMPLES)]
+    try:
+        zdict = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples)
+    except zstandard.ZstdError as e:
+        # not enough posts yet
+        log.warn(f"⚠️ No zstd dictionary ({e}); posts are compressed without one", also_print=True)
+        return
+
+    db.save_json_dict(zdict.dict_id(), zdict.as_bytes())
+    writer.flush()
+
+    with _lock:
+        _dicts[zdict.dict_id()] = zdict
+        _current_dict = zdict
+    log.info(f"  zstd dictionary {zdict.dict_id()} trained on {len(samples)} posts", also_print=True)
+
+
+def migrate():
+    """Store all the existing rows of the 'json' column the way PREFS['json_compression'] says
+
+    One transaction per MIGRATION_CHUNK rows, so that the database is never
+    locked for long (and the command can be interrupted and run again).
+    """
+
+    method = get_method()
+    log.info(f"Converting the 'json' column of the posts table to '{method}'", also_print=True)
+
+    if method == 'zstd' and get_current_dict() is None:
+        train_dict()
+
+    last_id = 0
+    count = 0
+    converted = 0
+    size_before = 0
+    size_after = 0
+
+    while rows := db.get_posts_json(last_id, MIGRATION_CHUNK):
+        for post_id, value in rows:
+            size_before += get_size(value)
+            if not is_current(value):
+                value = encode(decode(value))
+                db.save_post_json(post_id, value)
+                converted += 1
+            size_after += get_size(value)
+
+        writer.flush()
+        last_id = rows[-1][0]
+        count += len(rows)
+        log.info(f"  {count} posts processed", also_print=True)
+
+    log.info(f"Done. {converted} posts converted; the 'json' column went from {size_before / 1024**2:.1f} MB to {size_after / 1024**2:.1f} MB.", also_print=True)
+    log.info("The database file only gets smaller after a VACUUM (e.g. sqlite3 app.db 'VACUUM;'), while LAMA is not running.", also_print=True)
@@ -10,6 +10,8 @@ import src.utils as utils
 DEFAULT_PREFS = {
     "user_dir": f"{os.getcwd()}/user",
     "save_json": 1,
+    "json_format": "files",
+    "json_compression": "none",
 
     "fetch_reblogs": 1,
     "fetch_favourites": 1,
@@ -21,11 +23,25 @@ DEFAULT_PREFS = {
 
     "download_own_attachments": 1,
     "download_others_attachments": 1,
+    "download_workers": 8,
+    "download_per_host": 2,
+    "download_max_size": 0,
+    "media_dedupe": 1,
+    "defer_attachments": 0,
+    "media_budget_size": 0,
+    "media_budget_time": 0,
+    "media_order": "oldest",
 
     "fetch_limit": 25,
+    "account_workers": 1,
+    "refresh_limit": 1000,
+    "daemon_interval": 15,
     "recursion_limit": 100,
+    "crawl_workers": 4,
+    "ratelimit_reserve": 20,
     "log_level": "info",
-    "log_history_limit": 1000,
+    "log_max_size": 10,
+    "log_history_limit": 10,
 }
 
 
@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import src.fetch as f
+import src.log as log
+
+from . import PREFS
+
+
+# Related posts (reply parents and linked posts) are not fetched right away
+# by save_status(): they are added to a queue (the "frontier"), which is then
+# processed breadth-first by a small pool of workers (see run()).
+#
+# Each item is (account, kind, target, activity_type), where kind is 'parent'
+# (target: (id of the reply, id of its parent)) or 'link' (target: URL).
+
+CRAWL_LOG_INTERVAL = 10     # seconds between two progress messages
+
+# one frontier per account (handle), so that the run() of an account only
+# returns once all of its own related posts are saved, even when several
+# accounts are fetched in parallel (PREFS['account_workers'])
+_frontiers = {}     # {handle: deque of items}
+_seen = {}          # {handle: set of items already queued}
+_outstanding = {}   # {handle: number of items queued or running}
+_lock = threading.Condition()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def push(account, kind, target, activity_type):
+    """Queue a related post to be fetched"""
+
+    handle = account['handle']
+    key = (kind, str(target), activity_type)
+    with _lock:
+        seen = _seen.setdefault(handle, set())
+        if key in seen:
+            return
+        seen.add(key)
+        # we keep the log prefix of the thread that found this post
+        _frontiers.setdefault(handle, deque()).append((account, kind, target, activity_type, log.get_prefix()))
+        _outstanding[handle] = _outstanding.get(handle, 0) + 1
+        _lock.notify_all()
+
+
+def depth(account):
+    with _lock:
+        return len(_frontiers.get(account['handle'], ()))
+
+
+def run(account):
+    """Fetch all the queued related posts of an account (and the ones they lead to)
+
+    Returns once none of them is queued or running anymore, including the
+    ones taken by another run() for the same account (e.g. in daemon mode).
+    """
+
+    handle = account['handle']
+
+    with _lock:
+        if not _outstanding.get(handle):
+            return
+
+    workers = max(1, PREFS['crawl_workers'])
+    start = time.monotonic()
+    last_log = start
+    done_count = 0
+    running = set()
+
+    while True:
+        with _lock:
+            frontier = _frontiers.get(handle)
+            while frontier and len(running) < workers:
+                running.add(get_executor().submit(process, frontier.popleft()))
+
+            if not running:
+                if not _outstanding.get(handle):
+                    # all done: the same posts may be queued again later
+                    _frontiers.pop(handle, None)
+                    _seen.pop(handle, None)
+                    break
+                # some are still running in another run()
+                _lock.wait()
+                continue
+
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        done_count += len(done)
+        with _lock:
+            _outstanding[handle] -= len(done)
+            _lock.notify_all()
+
+        now = time.monotonic()
+        if now - last_log >= CRAWL_LOG_INTERVAL:
+            last_log = now
+            log.info(f"  crawl: {done_count} related posts fetched, {depth(account)} queued, {len(running)} running ({done_count / (now - start):.1f}/s)", also_print=True)
+
+    elapsed = time.monotonic() - start
+    log.info(f"  crawl: done, {done_count} related posts fetched in {elapsed:.1f}s")
+
+
+def process(item):
+    account, kind, target, activity_type, prefix = item
+    log.set_prefix(prefix)
+
+    try:
+        if kind == 'parent':
+            f.fetch_post_parents(account, *target, activity_type)
+        else:
+            f.fetch_post_by_url(account, target, activity_type)
+    except Exception as e:
+        log.err(f"❌ Failed to fetch {kind} {target} ({activity_type}): {type(e).__name__}: {e}", also_print=True)
+    finally:
+        log.set_prefix('')
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, PREFS['crawl_workers']), thread_name_prefix='crawl')
+    return _executor
+
+
+def shutdown():
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
@@ -0,0 +1,150 @@
+import threading
+import time
+
+from mastodon import MastodonError, StreamListener
+
+import src.crawler as crawler
+import src.db as db
+import src.download as download
+import src.fetch as f
+import src.log as log
+import src.pack as pack
+import src.utils as utils
+import src.writer as writer
+
+from . import __APP_NAME__
+from . import __VERSION__
+from . import ACCOUNTS
+from . import PREFS
+
+
+# Daemon mode: instead of being run periodically (cron), LAMA keeps running
+# and listens to the streaming API of each account. New posts and
+# notifications are saved as soon as they arrive; a normal fetch
+# (fetch.fetch_accounts) runs at start, every PREFS['daemon_interval']
+# minutes, and after each disconnection, to catch up with what the streams
+# don't deliver (favourites, bookmarks) or missed.
+
+DAEMON_RECONNECT_WAIT = 30      # seconds between two attempts to reconnect a stream
+DAEMON_CONNECT_MAX_WAIT = 900   # max. seconds between two attempts to connect an account at start
+
+
+class Listener(StreamListener):
+    """Saves the events of the user stream of one account"""
+
+    def __init__(self, account, catch_up):
+        super().__init__()
+        self.account = account
+        self.catch_up = catch_up
+
+    def on_update(self, status):
+        # the user stream is the home timeline: we only want our own posts
+        if utils.post_is_mine(self.account, status.account.url):
+            self.save(status, 'post')
+
+    def on_status_update(self, status):
+        # a post was edited
+        if utils.post_is_mine(self.account, status.account.url):
+            self.save(status, 'post')
+
+    def on_notification(self, notification):
+        if notification.type in f.get_notification_types() and notification.status:
+            self.save(notification, notification.type)
+
+    def on_abort(self, err):
+        log.set_prefix(f"[{self.account['handle']}] ")
+        log.warn(f"📡 Stream interrupted ({err}); reconnecting", also_print=True)
+        self.catch_up.set()
+
+    def on_unknown_event(self, name, unknown_event=None):
+        pass
+
+    def save(self, data, activity_type):
+        log.set_prefix(f"[{self.account['handle']}] ")
+        log.info(f"📡 {activity_type} {data.id} received", also_print=True)
+
+        try:
+            db.save_status(self.account, data, activity_type)
+            crawler.run(self.account)
+            writer.flush(wait=False)
+        except Exception as e:
+            log.err(f"❌ Failed to save {activity_type} {data.id}: {type(e).__name__}: {e}", also_print=True)
+
+
+def run():
+    print("")
+    log.info(f"Starting {__APP_NAME__} v.{__VERSION__} in daemon mode (Ctrl+C to stop)", also_print=True)
+
+    db.init_db()
+
+    catch_up = threading.Event()
+    streams = []
+    # accounts not connected yet: {handle: {'account', 'next_attempt', 'delay'}}
+    waiting = {account['handle']: {'account': account, 'next_attempt': 0, 'delay': DAEMON_RECONNECT_WAIT} for account in ACCOUNTS}
+    next_fetch = 0
+
+    try:
+        while True:
+            connect_streams(waiting, streams, catch_up)
+
+            if time.monotonic() >= next_fetch:
+                catch_up.clear()
+                try:
+                    results = f.fetch_accounts()
+                    writer.flush()
+                    f.log_summary(results)
+                except (MastodonError, OSError) as e:
+                    # e.g. the instance is unreachable: we try again at the next interval
+                    log.err(f"❌ Fetch failed: {type(e).__name__}: {e}", also_print=True)
+                next_fetch = time.monotonic() + PREFS['daemon_interval'] * 60
+
+            wake_at = min([next_fetch] + [state['next_attempt'] for state in waiting.values()])
+            if catch_up.wait(max(0, wake_at - time.monotonic())):
+                # a stream was interrupted: we catch up once it is back
+                time.sleep(DAEMON_RECONNECT_WAIT)
+                next_fetch = 0
+
+    except KeyboardInterrupt:
+        log.info("Stopping", also_print=True)
+
+    finally:
+        for stream in streams:
+            stream.close()
+        crawler.shutdown()
+        download.shutdown()
+        writer.stop()
+        pack.close()
+        db.close_all()
+
+
+def connect_streams(waiting, streams, catch_up):
+    """Start listening to the accounts that are due for a (new) attempt
+
+    An account that can't be reached (network error, 5xx...) stays in
+    {waiting}, and is tried again later, waiting twice as long each time.
+    """
+
+    now = time.monotonic()
+    for handle, state in list(waiting.items()):
+        if state['next_attempt'] > now:
+            continue
+        account = state['account']
+
+        try:
+            if not f.validate_username(account):
+                log.err(f"❌ Mismatch between configured username and authenticated username. Skipping {account['text']}.", also_print=True)
+                del waiting[handle]
+                continue
+
+            api = f.connect_api(account)
+            stream = api.stream_user(Listener(account, catch_up), run_async=True, reconnect_async=True, reconnect_async_wait_sec=DAEMON_RECONNECT_WAIT)
+
+        except (MastodonError, OSError) as e:
+            log.warn(f"📡 Could not connect to {account['text']} ({type(e).__name__}: {e}); next attempt in {state['delay']}s", also_print=True)
+            state['next_attempt'] = now + state['delay']
+            state['delay'] = min(state['delay'] * 2, DAEMON_CONNECT_MAX_WAIT)
+            continue
+
+        streams.append(stream)
+        del waiting[handle]
+        log.info(f"📡 Listening to {account['text']}", also_print=True)
@@ -1,37 +1,89 @@
+import functools
+import json
 import sqlite3
+import threading
+from datetime import datetime
 
+import src.compress as compress
+import src.crawler as crawler
 import src.log as log
 import src.save as save
 import src.utils as utils
-import src.fetch as f
+import src.writer as writer
 
 from . import __APP_NAME__
 from . import __VERSION__
 from . import PREFS
 
 
+# SQLite tuning, applied once to every new connection
+DB_CACHE_SIZE = -32000          # negative value = size in KiB (here ~32 MB)
+DB_MMAP_SIZE = 256 * 1024**2    # 256 MB
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0     # bumped by close_all(), so that threads reopen their connection
+
+
 def open_con():
-    db_path = f"{PREFS['user_dir']}/data/app.db"
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
-    return (con, cur)
+    """Get the database connection for the current thread
+
+    Connections are opened once (one per thread) and then reused for the
+    whole run, instead of being opened and closed for every single query.
+    """
+
+    con = getattr(_local, 'con', None)
+    if con is None or _local.generation != _generation:
+        db_path = f"{PREFS['user_dir']}/data/app.db"
+        con = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+        con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        # JSON of the 'json' column, compressed or not (see compress.py)
+        con.create_function('lama_json', 1, compress.decode, deterministic=True)
+        _local.con = con
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(con)
+
+    return (con, con.cursor())
+
+
+def close_all():
+    """Close every connection opened by open_con() (end of run)"""
+
+    global _generation
+
+    with _connections_lock:
+        _generation += 1
+        for con in _connections:
+            try:
+                con.close()
+            except sqlite3.Error as e:
+                log.err(f"❌ Failed to close database connection: {e}")
+        _connections.clear()
 
 
 def init_db():
     (con, cur) = open_con()
 
-    tables = ['posts', 'activities', 'states']
+    tables = ['posts', 'activities', 'states', 'media', 'pending_media', 'post_ids', 'missing_posts', 'link_resolutions', 'json_dicts']
+    new_tables = []
     for table in tables:
         res = cur.execute(
             f"SELECT name FROM sqlite_master WHERE name='{table}'")
         if res.fetchone() is None:
-            log.info(f"   Table '{table}' not found - initializing", True)
+            log.info(f"   Table '{table}' not found - initializing", also_print=True)
+            new_tables.append(table)
 
     cur.execute('''
         CREATE TABLE IF NOT EXISTS posts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             post_uri TEXT UNIQUE NOT NULL,
             post_id INTEGER NOT NULL,
+            url TEXT,
 
             author TEXT,
             visibility TEXT,
@@ -46,6 +98,7 @@ def init_db():
             created_at TEXT,
             edited_at TEXT,
             fetched_at TEXT NOT NULL DEFAULT (datetime('now','localtime')),
+            refreshed_at TEXT,
 
             json TEXT NOT NULL,
             note TEXT DEFAULT ""
@@ -77,63 +130,436 @@ def init_db():
         )
     ''')
 
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_uri TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            blob TEXT NOT NULL,
+            path TEXT NOT NULL,
+
+            UNIQUE(post_uri, idx)
+        )
+    ''')
+
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS media_blob ON media (blob)
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS pending_media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_uri TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            urls TEXT NOT NULL,
+            path TEXT NOT NULL,
+            description TEXT,
+            created_at TEXT,
+            queued_at TEXT NOT NULL DEFAULT (datetime('now','localtime')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT,
+            last_error TEXT,
+
+            UNIQUE(post_uri, idx)
+        )
+    ''')
+
+    # ids of the posts on each instance (a post has a different id on each
+    # instance that knows it), to find reply parents in the archive
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS post_ids (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            instance TEXT NOT NULL,
+            post_id TEXT NOT NULL,
+            post_uri TEXT NOT NULL,
+
+            UNIQUE(instance, post_id)
+        )
+    ''')
+
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS post_ids_uri ON post_ids (post_uri, instance)
+    ''')
+
+    # related posts that could not be found (deleted, or not reachable from
+    # this instance), not to be looked up again before 'expires_at'
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS missing_posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            instance TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            target TEXT NOT NULL,
+            checked_at TEXT NOT NULL DEFAULT (datetime('now','localtime')),
+            expires_at TEXT NOT NULL,
+
+            UNIQUE(instance, kind, target)
+        )
+    ''')
+
+    # links to Mastodon posts already resolved with a search (see
+    # utils.get_post_url_key for 'url_key')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS link_resolutions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url_key TEXT UNIQUE NOT NULL,
+            post_uri TEXT NOT NULL,
+            resolved_at TEXT NOT NULL DEFAULT (datetime('now','localtime')),
+            expires_at TEXT NOT NULL
+        )
+    ''')
+
+    # zstd dictionaries of the 'json' column of the posts (see compress.py)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS json_dicts (
+            dict_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now','localtime'))
+        )
+    ''')
+
+    # databases created by older versions
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(posts)")]
+    if 'url' not in columns:
+        log.info("   Adding column 'url' to table 'posts'", also_print=True)
+        cur.execute("ALTER TABLE posts ADD COLUMN url TEXT")
+        cur.execute("UPDATE posts SET url = json_extract(lama_json(json), '$.url')")
+    if 'refreshed_at' not in columns:
+        log.info("   Adding column 'refreshed_at' to table 'posts'", also_print=True)
+        cur.execute("ALTER TABLE posts ADD COLUMN refreshed_at TEXT")
+
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS posts_url ON posts (url)
+    ''')
+
+    if 'post_ids' in new_tables:
+        # the activities tell us which id each post has on the instance of
+        # the account (except for mentions and polls: notification id)
+        cur.execute('''
+            INSERT OR IGNORE INTO post_ids (instance, post_id, post_uri)
+            SELECT substr(account, instr(account, '@') + 1), CAST(activity_id AS TEXT), post_uri
+            FROM activities
+            WHERE activity_type NOT IN ('mention', 'poll')
+        ''')
+
     con.commit()
 
     save_app_state(__APP_NAME__, 'app_version', __VERSION__)
-    con.close()
+    writer.flush()
+
+
+# All writes go through the writer thread (see writer.py); for each table:
+# - 'sql': the statement used (with executemany) to write a batch of rows
+# - 'key': what identifies a row, used to look up rows not yet committed
+WRITES = {
+    'posts': {
+        # the blobs of the attachments (:media, JSON array of [idx, blob, path])
+        # are written along with the post, so that they always match its
+        # 'attachments' column
+        'sql': [
+            """
+                INSERT OR REPLACE INTO posts (
+                    post_uri, post_id, url, author, visibility,
+                    content, hashtags, mentions, links, attachments, poll_options,
+                    reblog, created_at, edited_at, json, refreshed_at
+                ) VALUES (
+                    :post_uri, :post_id, :url, :author, :visibility,
+                    :content, :hashtags, :mentions, :links, :attachments, :poll_options,
+                    :reblog, :created_at, :edited_at, :json, :refreshed_at
+                )
+            """,
+            """
+                DELETE FROM media WHERE post_uri = :post_uri
+            """,
+            """
+                INSERT INTO media (
+                    post_uri, idx, blob, path
+                )
+                SELECT :post_uri, json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]')
+                FROM json_each(:media)
+            """,
+        ],
+        'key': lambda row: row['post_uri'],
+    },
+    'activities': {
+        'sql': """
+            INSERT OR REPLACE INTO activities (
+                account, post_uri, activity_type, activity_id
+            ) VALUES (
+                :account, :post_uri, :activity_type, :activity_id
+            )
+        """,
+        'key': lambda row: (row['account'], row['post_uri'], row['activity_type']),
+    },
+    'states': {
+        'sql': """
+            INSERT INTO states (
+                account, name, value
+            ) VALUES (
+                :account, :name, :value
+            )
+            ON CONFLICT(account, name) DO UPDATE SET
+                value = excluded.value;
+        """,
+        'key': lambda row: (row['account'], row['name']),
+    },
+    'media': {
+        'sql': """
+            INSERT INTO media (
+                post_uri, idx, blob, path
+            ) VALUES (
+                :post_uri, :idx, :blob, :path
+            )
+            ON CONFLICT(post_uri, idx) DO UPDATE SET
+                blob = excluded.blob,
+                path = excluded.path;
+        """,
+        'key': lambda row: (row['post_uri'], row['idx']),
+    },
+    'pending_media': {
+        'sql': """
+            INSERT INTO pending_media (
+                post_uri, idx, urls, path, description, created_at
+            ) VALUES (
+                :post_uri, :idx, :urls, :path, :description, :created_at
+            )
+            ON CONFLICT(post_uri, idx) DO UPDATE SET
+                urls = excluded.urls,
+                path = excluded.path,
+                description = excluded.description,
+                attempts = 0,
+                next_attempt_at = NULL,
+                last_error = NULL;
+        """,
+        'key': lambda row: (row['post_uri'], row['idx']),
+    },
+    'pending_media_description': {
+        # description edited before the attachment was downloaded
+        'sql': """
+            UPDATE pending_media SET description = :description WHERE post_uri = :post_uri AND idx = :idx
+        """,
+        'key': lambda row: (row['post_uri'], row['idx']),
+    },
+    'pending_media_retry': {
+        'sql': """
+            UPDATE pending_media SET
+                attempts = :attempts,
+                next_attempt_at = :next_attempt_at,
+                last_error = :last_error
+            WHERE post_uri = :post_uri AND idx = :idx
+        """,
+        'key': lambda row: (row['post_uri'], row['idx']),
+    },
+    'pending_media_done': {
+        'sql': """
+            DELETE FROM pending_media WHERE post_uri = :post_uri AND idx = :idx
+        """,
+        'key': lambda row: (row['post_uri'], row['idx']),
+    },
+    'post_ids': {
+        'sql': """
+            INSERT OR REPLACE INTO post_ids (
+                instance, post_id, post_uri
+            ) VALUES (
+                :instance, :post_id, :post_uri
+            )
+        """,
+        'key': lambda row: (row['instance'], row['post_id']),
+    },
+    'missing_posts': {
+        'sql': """
+            INSERT INTO missing_posts (
+                instance, kind, target, expires_at
+            ) VALUES (
+                :instance, :kind, :target, :expires_at
+            )
+            ON CONFLICT(instance, kind, target) DO UPDATE SET
+                checked_at = datetime('now','localtime'),
+                expires_at = excluded.expires_at;
+        """,
+        'key': lambda row: (row['instance'], row['kind'], row['target']),
+    },
+    'link_resolutions': {
+        'sql': """
+            INSERT INTO link_resolutions (
+                url_key, post_uri, expires_at
+            ) VALUES (
+                :url_key, :post_uri, :expires_at
+            )
+            ON CONFLICT(url_key) DO UPDATE SET
+                post_uri = excluded.post_uri,
+                resolved_at = datetime('now','localtime'),
+                expires_at = excluded.expires_at;
+        """,
+        'key': lambda row: row['url_key'],
+    },
+    'refreshed': {
+        # post checked by refresh.py, unchanged
+        'sql': """
+            UPDATE posts SET
+                refreshed_at = datetime('now','localtime')
+            WHERE post_uri = :post_uri
+        """,
+        'key': lambda row: row['post_uri'],
+    },
+    'post_json': {
+        # 'json' column stored another way (see compress.migrate)
+        'sql': """
+            UPDATE posts SET json = :json WHERE id = :id
+        """,
+        'key': lambda row: row['id'],
+    },
+    'json_dicts': {
+        'sql': """
+            INSERT OR REPLACE INTO json_dicts (dict_id, data) VALUES (:dict_id, :data)
+        """,
+        'key': lambda row: row['dict_id'],
+    },
+    'attachment': {
+        # replace one entry of the 'attachments' column, and its blob (if any)
+        'sql': [
+            """
+                UPDATE posts SET
+                    attachments = json_set(attachments, '$[' || :idx || ']', json(:entry))
+                WHERE post_uri = :post_uri
+            """,
+            """
+                DELETE FROM media WHERE post_uri = :post_uri AND idx = :idx
+            """,
+            """
+                INSERT INTO media (
+                    post_uri, idx, blob, path
+                )
+                SELECT :post_uri, :idx, :blob, :path WHERE :blob IS NOT NULL
+            """,
+        ],
+        'key': lambda row: (row['post_uri'], row['idx']),
+    },
+}
+
+
+def write_batch(batch):
+    """Write a batch of (table, row) in one single transaction
+
+    Called by the writer thread only. Rows are grouped by table and written
+    with executemany (with each statement, if WRITES[table]['sql'] is a list);
+    each group runs in a savepoint, and if it fails we go through its rows one
+    by one, so that one bad row doesn't drop the others.
+    If the transaction itself fails, it is rolled back and the error raised.
+    """
+
+    (con, cur) = open_con()
+
+    groups = {}
+    for table, row in batch:
+        groups.setdefault(table, []).append(row)
+
+    try:
+        cur.execute("BEGIN")
+        for table, rows in groups.items():
+            sql = WRITES[table]['sql']
+            statements = sql if isinstance(sql, list) else [sql]
+
+            cur.execute("SAVEPOINT batch")
+            try:
+                for statement in statements:
+                    cur.executemany(statement, rows)
+                cur.execute("RELEASE batch")
+                continue
+            except sqlite3.Error as e:
+                cur.execute("ROLLBACK TO batch")
+                cur.execute("RELEASE batch")
+                log.warn(f"Batch insert into '{table}' failed ({e}); retrying row by row")
+
+            for row in rows:
+                cur.execute("SAVEPOINT row")
+                try:
+                    for statement in statements:
+                        cur.execute(statement, row)
+                    cur.execute("RELEASE row")
+                except sqlite3.Error as e:
+                    cur.execute("ROLLBACK TO row")
+                    cur.execute("RELEASE row")
+                    log.err(f"❌ Failed to save row in '{table}': {e}", also_print=True)
+                    log.err(f"  {row}")
+        con.commit()
+    except Exception:
+        # e.g. "database is locked": without a rollback the connection would
+        # stay in this transaction, and every later batch would fail as well
+        if con.in_transaction:
+            con.rollback()
+        raise
 
 
-def save_status(account, data, activity_type):
+def save_status(account, data, activity_type, follow_parents=True, refresh=False):
     """Save one post to the database
 
     Note: if activity_type == mention or poll, the structure is different
+
+    follow_parents=False: don't queue the parent of this post (used for
+    ancestors, when the whole chain has already been fetched)
+
+    refresh=True: new version of a post already saved (see refresh.py); the
+    post is saved again even if 'edited_at' didn't change, and no activity
+    is recorded
     """
 
     log.info(f"db.save_status {data['id']} ({activity_type}) for {account['text']}")
-    log.debug(f"  {utils.to_json(data.__dict__)}")
-
-    if PREFS['save_json'] and activity_type != 'reblog':
-        save.save_to_json(account, data, activity_type)
 
+    # serialized once for the log, the JSON file and the 'json' column
+    data_payload = utils.Payload(data)
+    log.debug(lambda: f"  {data_payload.compact()}")
 
     if activity_type in {'mention', 'poll'}:
         status = data.status
+        payload = utils.Payload(status)
     else:
         status = data
+        payload = data_payload
 
     post_uri = status.uri
 
     # avoid saving posts or activities twice
     save_post = True
-    save_activity = True
+    save_activity = not refresh
 
-    saved_activity = get_unique_activity(account, post_uri, activity_type)
+    saved_activity = save_activity and get_unique_activity(account, post_uri, activity_type)
     if saved_activity:
         log.info(f"🟰 Activity {activity_type} by {account['handle']} for {post_uri}is already present in database with the same 'edited_at value; skipping.'")
         save_activity = False
 
     saved_post = get_post_last_edited(post_uri)
+    saved_attachments = {}
     if saved_post:
         db_edited_at, = saved_post
-        if db_edited_at == status.edited_at:
+        # dates are stored as text in the database
+        if refresh:
+            log.info(f"🔄 Post {post_uri} has changed; we update the data.")
+            saved_attachments = get_saved_attachments(post_uri)
+        elif str(db_edited_at) == str(status.edited_at):
             log.info(f"🟰 Post {post_uri} ({activity_type}) already present in database with the same 'edited_at value; skipping.'")
             save_post = False
         else:
             log.warn(f"🆕 Post {post_uri} ({activity_type}) already present in database, with different 'edited_at' values (this post: {status.edited_at}; db post: {db_edited_at}); we proceed and update the data.")
+            # no need to download again the attachments that didn't change
+            saved_attachments = get_saved_attachments(post_uri)
 
-    (con, cur) = open_con()
+    # nothing new (e.g. an ancestor met again, or a post both streamed and
+    # fetched): the JSON file would only be a copy (appended again if packed)
+    if PREFS['save_json'] and activity_type != 'reblog' and not refresh and (save_post or save_activity):
+        save.save_to_json(account, data, activity_type, data_payload)
 
     if save_post:
         post_id =      status.id
         author =       utils.get_handle(status.account.url)
         visibility =   status.get('visibility', None)
-        content =      utils.strip_html(status.get('content', ''))
+        content, links = utils.parse_content(status.get('content', ''))
         hashtags =     utils.extract_tags(status.get('tags', []))
         mentions =     utils.extract_mentions(status.get('mentions', []))
-        links =        utils.extract_links(status.get('content', ''))
-        attachments =  save.save_attachments(account, status)
+        attachments =  save.save_attachments(account, status, saved_attachments)
+        # called by the writer, and maybe by get_saved_attachments() before that
+        collected =    functools.cache(lambda: save.collect_attachments(attachments))
         poll_options = utils.extract_poll_options(status.get('poll', []))
-        js =           utils.to_json(status.__dict__)
+        js =           payload.compact()
 
         reblog_uri = None
         if status.reblog and status.reblog.uri:
@@ -142,7 +568,7 @@ def save_status(account, data, activity_type):
 
             if PREFS['fetch_reblogs']:
                 # we also save its embedded content as a distinct post
-                save_status(account, status.reblog, 'reblog')
+                save_status(account, status.reblog, 'reblog', refresh=refresh)
             else:
                 # we do not want to save reblogs...
                 if content or attachments or poll_options:
@@ -158,54 +584,33 @@ def save_status(account, data, activity_type):
         post_data = {
             'post_uri':     post_uri,
             'post_id':      post_id,
+            'url':          status.get('url', None),
             'author':       author,
             'visibility':   visibility,
             'content':      content,
             'hashtags':     utils.to_json(hashtags)     if hashtags     else None,
             'mentions':     utils.to_json(mentions)     if mentions     else None,
             'links':        utils.to_json(links)        if links        else None,
-            'attachments':  utils.to_json(attachments)  if attachments  else None,
+            # downloads are still running; the writer resolves this once they are done
+            'attachments':  collected if attachments else None,
             'poll_options': utils.to_json(poll_options) if poll_options else None,
             'reblog':       reblog_uri,
             'created_at':   status['created_at'],
             'edited_at':    status['edited_at'],
-            'json':         js
+            'json':         compress.encode(js),
+            'refreshed_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S') if refresh else None,
+            # not a column: rows of the 'media' table (see WRITES['posts'])
+            'media':        (lambda: save.collect_media(attachments)) if attachments else '[]',
         }
 
-        cur.execute("""
-            INSERT OR REPLACE INTO posts (
-                post_uri, post_id, author, visibility,
-                content, hashtags, mentions, links, attachments, poll_options,
-                reblog, created_at, edited_at, json
-            ) VALUES (
-                :post_uri, :post_id, :author, :visibility,
-                :content, :hashtags, :mentions, :links, :attachments, :poll_options,
-                :reblog, :created_at, :edited_at, :json
-            )
-        """, post_data)
-        con.commit()
+        writer.put('posts', post_data)
 
     if save_activity:
         activity_id = data.id if activity_type in {'mention', 'poll'} else status.id
+        save_activity_row(account, post_uri, activity_type, activity_id)
 
-        log.debug(f"Saving activity {activity_id}: {activity_type} by {account['handle']} for {post_uri}")
-
-        activity_data = {
-            'account': account['handle'],
-            'post_uri': post_uri,
-            'activity_type': activity_type,
-            'activity_id': activity_id,
-        }
-        cur.execute("""
-            INSERT OR REPLACE INTO activities (
-                account, post_uri, activity_type, activity_id
-            ) VALUES (
-                :account, :post_uri, :activity_type, :activity_id
-            )
-        """, activity_data)
-        con.commit()
-
-    con.close()
+    if save_post or save_activity:
+        save_post_id(account, status.id, post_uri)
 
     # fetch related posts:
     #
@@ -219,49 +624,228 @@ def save_status(account, data, activity_type):
     # recursively (e.g. a parent of a parent of a parent..., OR a link in a link in a link)
     # because it makes sense to get the full context; however we do not mix the two,
     # ie. we do NOT fetche a link found in a parent, or a parent of a link.
+    #
+    # Related posts are not fetched here: they are queued, and fetched by crawler.run()
 
-    if save_post:
+    if save_post and not refresh:
 
-        if activity_type.count('.') >= PREFS['recursion_limit']:
-            log.warn(f"⛔ STOP. We don't want to go any deeper than that (PREFS['recursion_limit'] is {PREFS['recursion_limit']}).", True)
+        if get_depth(activity_type) >= PREFS['recursion_limit']:
+            log.warn(f"⛔ STOP. We don't want to go any deeper than that (PREFS['recursion_limit'] is {PREFS['recursion_limit']}).", also_print=True)
             log.warn(f"  {activity_type}")
             return
 
         is_reply = status.in_reply_to_id
-        if is_reply and PREFS['fetch_reply_parents']:
+        if is_reply and PREFS['fetch_reply_parents'] and follow_parents:
             if '.link' in activity_type:
                 # don't fetch the parent of a quoted post
                 pass
             else:
-                # "bookmark"          becomes "bookmark.parent"
-                # "bookmark.parent"   becomes "bookmark.parent#2"
-                # "bookmark.parent#2" becomes "bookmark.parent#3" etc
-                if activity_type.endswith('.parent'):
-                    new_activity = f'{activity_type}#2'
-                elif '.parent#' in activity_type:
-                    act, count = activity_type.split('.parent#')
-                    new_activity = f'{act}.parent#{int(count) + 1}'
-                else:
-                    new_activity = f'{activity_type}.parent'
-
-                f.fetch_post_from_id(account, is_reply, new_activity)
+                # all the ancestors are fetched at once (see fetch.fetch_post_parents)
+                new_activity = get_related_activity(activity_type, 'parent')
+                crawler.push(account, 'parent', (status.id, is_reply), new_activity)
 
         if links and PREFS['fetch_linked_posts']:
             if '.parent' in activity_type:
                 # don't fetch a post quoted in a parent
                 pass
             else:
-                # same logic as above: X.link, X.link#2, X.link#3...
-                if activity_type.endswith('.link'):
-                    new_activity = f'{activity_type}#2'
-                elif '.link#' in activity_type:
-                    act, count = activity_type.split('.link#')
-                    new_activity = f'{act}.link#{int(count) + 1}'
-                else:
-                    new_activity = f'{activity_type}.link'
+                new_activity = get_related_activity(activity_type, 'link')
                 for link in links:
                     if (link['mastodon']):
-                        f.fetch_post_by_url(account, link['url'], new_activity)
+                        crawler.push(account, 'link', link['url'], new_activity)
+
+
+def get_related_activity(activity_type, kind):
+    """Activity type of a related post (kind: 'parent' or 'link')
+
+    "bookmark"          becomes "bookmark.parent"
+    "bookmark.parent"   becomes "bookmark.parent#2"
+    "bookmark.parent#2" becomes "bookmark.parent#3" etc
+    (same logic for links: X.link, X.link#2, X.link#3...)
+    """
+
+    if activity_type.endswith(f'.{kind}'):
+        return f'{activity_type}#2'
+    if f'.{kind}#' in activity_type:
+        act, count = activity_type.split(f'.{kind}#')
+        return f'{act}.{kind}#{int(count) + 1}'
+    return f'{activity_type}.{kind}'
+
+
+def get_depth(activity_type):
+    """How many related posts away from the base activity (e.g. "bookmark.parent#3" is 3)"""
+
+    if '.' not in activity_type:
+        return 0
+    count = activity_type.rsplit('#', 1)[1] if '#' in activity_type else 1
+    return int(count)
+
+
+def save_activity_row(account, post_uri, activity_type, activity_id):
+    """Record an activity (account + post URI + activity type)"""
+
+    log.debug(f"Saving activity {activity_id}: {activity_type} by {account['handle']} for {post_uri}")
+
+    activity_data = {
+        'account': account['handle'],
+        'post_uri': post_uri,
+        'activity_type': activity_type,
+        'activity_id': activity_id,
+    }
+    writer.put('activities', activity_data)
+
+
+def save_post_id(account, post_id, post_uri):
+    """Record the id of a post on the instance of this account"""
+
+    writer.put('post_ids', {
+        'instance': utils.get_instance(account['instance']),
+        'post_id': str(post_id),
+        'post_uri': post_uri,
+    })
+
+
+def get_post_by_id(account, post_id):
+    """Get the URI of a post from its id on the instance of this account, if it's in the archive"""
+
+    instance = utils.get_instance(account['instance'])
+    pending = writer.pending('post_ids', (instance, str(post_id)))
+    if pending:
+        return pending['post_uri']
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT post_ids.post_uri
+        FROM post_ids
+        JOIN posts ON posts.post_uri = post_ids.post_uri
+        WHERE post_ids.instance = ? AND post_ids.post_id = ?
+    """, (instance, str(post_id)))
+    result = cur.fetchone()
+
+    return result[0] if result else None
+
+
+def get_post_by_url(account, url):
+    """Find a post in the archive from its URI or URL
+
+    Output: (post_uri, id of the post on the instance of this account, or
+    None if the post was never fetched from this instance), or None
+    """
+
+    instance = utils.get_instance(account['instance'])
+
+    pending = writer.pending('posts', url)
+    if pending:
+        # the id of a queued post is only known to be ours if its post_ids row is
+        pending_id = writer.pending('post_ids', (instance, str(pending['post_id'])))
+        if pending_id and pending_id['post_uri'] == pending['post_uri']:
+            return (pending['post_uri'], pending['post_id'])
+        return (pending['post_uri'], None)
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT posts.post_uri, post_ids.post_id
+        FROM posts
+        LEFT JOIN post_ids ON post_ids.post_uri = posts.post_uri AND post_ids.instance = ?
+        WHERE posts.post_uri = ? OR posts.url = ?
+        LIMIT 1
+    """, (instance, url, url))
+    result = cur.fetchone()
+
+    return result if result else None
+
+
+def save_missing_post(account, kind, target, expires_at):
+    """Remember that a related post (kind: 'parent' or 'link') could not be found"""
+
+    writer.put('missing_posts', {
+        'instance': utils.get_instance(account['instance']),
+        'kind': kind,
+        'target': str(target),
+        'expires_at': expires_at,
+    })
+
+
+def is_missing_post(account, kind, target):
+    """Whether a related post could not be found recently (see save_missing_post)"""
+
+    instance = utils.get_instance(account['instance'])
+    if writer.pending('missing_posts', (instance, kind, str(target))):
+        return True
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT id FROM missing_posts WHERE
+        instance = ? AND
+        kind = ? AND
+        target = ? AND
+        expires_at > datetime('now','localtime')
+    """, (instance, kind, str(target)))
+
+    return cur.fetchone() is not None
+
+
+def save_link_resolution(url_key, post_uri, expires_at):
+    """Remember which post a link leads to"""
+
+    writer.put('link_resolutions', {
+        'url_key': url_key,
+        'post_uri': post_uri,
+        'expires_at': expires_at,
+    })
+
+
+def get_link_resolution(url_key):
+    """Get the URI of the post a link leads to, if it was resolved recently"""
+
+    pending = writer.pending('link_resolutions', url_key)
+    if pending:
+        return pending['post_uri']
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT post_uri FROM link_resolutions WHERE
+        url_key = ? AND
+        expires_at > datetime('now','localtime')
+    """, (url_key,))
+    result = cur.fetchone()
+
+    return result[0] if result else None
+
+
+def get_posts_to_refresh(account, started_at, days=None, limit=None):
+    """Get the posts to check for changes with the account (see refresh.py)
+
+    Posts known on the instance of this account, not checked since
+    {started_at}, least recently checked first; only those created in the
+    last {days} days if set.
+
+    Output: [(id of the post on the instance, post_uri, edited_at, poll (JSON))]
+    """
+
+    params = [utils.get_instance(account['instance']), started_at]
+    where_days = ''
+    if days:
+        where_days = "AND posts.created_at >= datetime('now', ?)"
+        params.append(f'-{days} days')
+    params.append(limit if limit else -1)
+
+    (con, cur) = open_con()
+    cur.execute(f"""
+        SELECT post_ids.post_id, posts.post_uri, posts.edited_at, json_extract(lama_json(posts.json), '$.poll')
+        FROM post_ids
+        JOIN posts ON posts.post_uri = post_ids.post_uri
+        WHERE post_ids.instance = ?
+            AND (posts.refreshed_at IS NULL OR posts.refreshed_at < ?)
+            {where_days}
+        ORDER BY COALESCE(posts.refreshed_at, posts.fetched_at) ASC
+        LIMIT ?
+    """, params)
+    return cur.fetchall()
+
+
+def save_refreshed(post_uri):
+    writer.put('refreshed', {'post_uri': post_uri})
 
 
 def get_last_fetched_id(account, activity_type='post'):
@@ -277,7 +861,6 @@ def get_last_fetched_id(account, activity_type='post'):
         LIMIT 1
     """, (account['handle'], activity_type))
     result = cur.fetchone()
-    con.close()
 
     return result[0] if result and result[0] else None
 
@@ -290,22 +873,75 @@ def get_post_last_edited(uri):
     (and his attachmens downloaded again), or not.
     """
 
+    pending = writer.pending('posts', uri)
+    if pending:
+        return (pending['edited_at'],)
+
     (con, cur) = open_con()
     cur.execute("""
         SELECT edited_at FROM posts WHERE post_uri = ?
     """, (uri,))
     result = cur.fetchone()
-    con.close()
 
     return result if result else False
 
 
+def get_saved_attachments(uri):
+    """Get the attachments already saved for a post, by media id
+
+    Output: {media_id: {'idx', 'url', 'remote_url', 'entry', 'blob'}}, where 'entry' is
+    the [path, description] from the 'attachments' column, and 'blob' the
+    corresponding file in the blob store (or None)
+    """
+
+    pending = writer.pending('posts', uri)
+    if pending:
+        # saved earlier in this run, not committed yet
+        result = (pending['attachments'], pending['json'])
+        if callable(result[0]):
+            # waits for the downloads of that version
+            result = (result[0](), result[1])
+        media = pending['media']() if callable(pending['media']) else pending['media']
+        blobs = {idx: blob for idx, blob, path in json.loads(media)}
+    else:
+        (con, cur) = open_con()
+        cur.execute("""
+            SELECT attachments, json FROM posts WHERE post_uri = ?
+        """, (uri,))
+        result = cur.fetchone()
+        cur.execute("""
+            SELECT idx, blob FROM media WHERE post_uri = ?
+        """, (uri,))
+        blobs = dict(cur.fetchall())
+
+    if not result or not result[0]:
+        return {}
+
+    entries = json.loads(result[0])
+    media_attachments = json.loads(compress.decode(result[1])).get('media_attachments') or []
+
+    saved = {}
+    for idx, att in enumerate(media_attachments):
+        if idx < len(entries):
+            saved[str(att['id'])] = {
+                'idx': idx,
+                'url': att.get('url'),
+                'remote_url': att.get('remote_url'),
+                'entry': entries[idx],
+                'blob': blobs.get(idx),
+            }
+    return saved
+
+
 def get_unique_activity(account, post_uri, activity_type):
     """Get the id of a specific activity (account + post URI + activity type)
 
     Used to determines whether an activity has already been saved to the database.
     """
 
+    if writer.pending('activities', (account['handle'], post_uri, activity_type)):
+        return True
+
     (con, cur) = open_con()
     cur.execute("""
         SELECT id FROM activities WHERE
@@ -314,7 +950,6 @@ def get_unique_activity(account, post_uri, activity_type):
         activity_type = ?
     """, (account['handle'], post_uri, activity_type))
     result = cur.fetchone()
-    con.close()
 
     return result if result else False
 
@@ -332,23 +967,16 @@ def save_app_state(handle, name, value):
         'value': value,
     }
 
-    (con, cur) = open_con()
-    cur.execute("""
-        INSERT INTO states (
-            account, name, value
-        ) VALUES (
-            :account, :name, :value
-        )
-        ON CONFLICT(account, name) DO UPDATE SET
-            value = excluded.value;
-    """, data)
-    con.commit()
-    con.close()
+    writer.put('states', data)
 
 
 def get_app_state(handle, name):
     """Get app-related states (e.g pagination data for favourites)"""
 
+    pending = writer.pending('states', (handle, name))
+    if pending:
+        return pending['value']
+
     (con, cur) = open_con()
     cur.execute(f"""
         SELECT value FROM states WHERE
@@ -356,7 +984,160 @@ def get_app_state(handle, name):
         name = ?
     """, (handle, name))
     result = cur.fetchone()
-    con.close()
 
     return result[0] if result and result[0] else None
 
+
+
+def save_media(post_uri, idx, blob, path):
+    """Record which blob (see blobs.py) holds an attachment of a post"""
+
+    writer.put('media', {
+        'post_uri': post_uri,
+        'idx': idx,
+        'blob': blob,
+        'path': path,
+    })
+
+
+def get_posts_content(limit=None):
+    """Get the HTML content of the saved posts (see bench.py)"""
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT json_extract(lama_json(json), '$.content') FROM posts LIMIT ?
+    """, (limit if limit else -1,))
+    return [content for content, in cur.fetchall() if content]
+
+
+def get_posts_json(after_id, limit):
+    """Get the 'json' column of the posts, by id: [(id, json)] (see compress.py)"""
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT id, json FROM posts WHERE id > ? ORDER BY id LIMIT ?
+    """, (after_id, limit))
+    return cur.fetchall()
+
+
+def get_posts_json_sample(limit):
+    """Get the 'json' column of the most recent posts (see compress.py)"""
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT json FROM posts ORDER BY id DESC LIMIT ?
+    """, (limit,))
+    return [value for value, in cur.fetchall()]
+
+
+def save_post_json(id, value):
+    writer.put('post_json', {
+        'id': id,
+        'json': value,
+    })
+
+
+def get_json_dict(dict_id=None):
+    """Get a zstd dictionary: (dict_id, data); the most recent one if no dict_id"""
+
+    (con, cur) = open_con()
+    if dict_id is None:
+        cur.execute("""
+            SELECT dict_id, data FROM json_dicts ORDER BY created_at DESC, rowid DESC LIMIT 1
+        """)
+    else:
+        cur.execute("""
+            SELECT dict_id, data FROM json_dicts WHERE dict_id = ?
+        """, (dict_id,))
+    return cur.fetchone()
+
+
+def save_json_dict(dict_id, data):
+    writer.put('json_dicts', {
+        'dict_id': dict_id,
+        'data': data,
+    })
+
+
+def get_posts_attachments():
+    """Iterate over (post_uri, attachments) for all posts with attachments"""
+
+    (con, cur) = open_con()
+    cur.execute("""
+        SELECT post_uri, attachments FROM posts WHERE attachments IS NOT NULL
+    """)
+    yield from cur
+
+
+def save_pending_media(post_uri, idx, urls, path, description, created_at):
+    """Record an attachment to be downloaded later (see media.py)"""
+
+    writer.put('pending_media', {
+        'post_uri': post_uri,
+        'idx': idx,
+        'urls': utils.to_json(urls),
+        'path': path,
+        'description': description,
+        'created_at': created_at,
+    })
+
+
+def save_pending_description(post_uri, idx, description):
+    writer.put('pending_media_description', {
+        'post_uri': post_uri,
+        'idx': idx,
+        'description': description,
+    })
+
+
+def retry_pending_media(post_uri, idx, attempts, next_attempt_at, last_error):
+    writer.put('pending_media_retry', {
+        'post_uri': post_uri,
+        'idx': idx,
+        'attempts': attempts,
+        'next_attempt_at': next_attempt_at,
+        'last_error': last_error,
+    })
+
+
+def delete_pending_media(post_uri, idx):
+    writer.put('pending_media_done', {
+        'post_uri': post_uri,
+        'idx': idx,
+    })
+
+
+def get_pending_media(newest_first=False):
+    """Get the attachments waiting to be downloaded (and not waiting for a retry)"""
+
+    (con, cur) = open_con()
+    cur.execute(f"""
+        SELECT post_uri, idx, urls, path, description, attempts
+        FROM pending_media
+        WHERE next_attempt_at IS NULL
+            OR next_attempt_at <= datetime('now','localtime')
+        ORDER BY created_at {'DESC' if newest_first else 'ASC'}, idx
+    """)
+    columns = [col[0] for col in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def count_pending_media():
+    (con, cur) = open_con()
+    cur.execute("SELECT COUNT(*) FROM pending_media")
+    return cur.fetchone()[0]
+
+
+def save_attachment_entry(post_uri, idx, entry, blob=None):
+    """Update one attachment (path or error, description) of a saved post
+
+    blob: file in the blob store (see blobs.py) of a downloaded attachment
+    """
+
+    writer.put('attachment', {
+        'post_uri': post_uri,
+        'idx': idx,
+        'entry': utils.to_json(entry),
+        'blob': blob,
+        'path': entry[0],
+    })
@@ -0,0 +1,101 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import src.utils as utils
+
+from . import PREFS
+
+
+# Attachments are downloaded in a pool of threads, so that a slow remote
+# instance doesn't stall the whole fetch loop. The number of simultaneous
+# downloads from a single host is capped (PREFS['download_per_host']): the
+# downloads beyond that wait in a queue of their host, not in a worker, so
+# that the other hosts still get the whole pool.
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_hosts = {}     # {host: {'running': number of workers on this host, 'queue': jobs waiting}}
+_hosts_lock = threading.Lock()
+
+
+def submit(fn, *args, url=None):
+    """Run fn(*args) in the download pool, and return a Future
+
+    url: what fn downloads (first URL), for the per-host limit
+
+    If PREFS['download_workers'] is 0, fn is run immediately (in the calling
+    thread) and the Future we return is already done.
+    """
+
+    if PREFS['download_workers'] < 1:
+        try:
+            return done(fn(*args))
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    host = utils.get_instance(url) if url else None
+    future = Future()
+    job = (future, fn, args)
+
+    with _hosts_lock:
+        state = _hosts.setdefault(host, {'running': 0, 'queue': deque()})
+        if host is not None and state['running'] >= max(1, PREFS['download_per_host']):
+            # started by a worker of this host once it is done (see _run)
+            state['queue'].append(job)
+            return future
+        state['running'] += 1
+
+    get_executor().submit(_run, host, job)
+    return future
+
+
+def _run(host, job):
+    """Run a job, then the jobs queued for the same host, if any"""
+
+    while job:
+        future, fn, args = job
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        with _hosts_lock:
+            state = _hosts[host]
+            job = state['queue'].popleft() if state['queue'] else None
+            if job is None:
+                state['running'] -= 1
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PREFS['download_workers'], thread_name_prefix='download')
+    return _executor
+
+
+def done(value):
+    """A Future that is already done"""
+
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def shutdown():
+    """Wait for all downloads to complete, and stop the pool"""
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
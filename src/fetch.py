@@ -1,10 +1,21 @@
-from datetime import datetime
-from mastodon import Mastodon, MastodonError
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
+import requests
+from mastodon import Mastodon, MastodonError, MastodonNotFoundError
+
+import src.crawler as crawler
 import src.db as db
+import src.download as download
 import src.log as log
+import src.media as media
+import src.pack as pack
+import src.ratelimit as ratelimit
 import src.save as save
 import src.utils as utils
+import src.writer as writer
 
 from . import __APP_NAME__
 from . import __VERSION__
@@ -12,21 +23,66 @@ from . import ACCOUNTS
 from . import PREFS
 
 
+HTTP_POOL_SIZE = 10             # connections kept alive per host
+MISSING_POST_EXPIRY = 7         # days before we look again for a related post that was not found
+LINK_RESOLUTION_EXPIRY = 30     # days before we search again for a link already resolved
+PAGE_PREFETCH = 3               # pages of results fetched ahead of the one being saved
+
+_clients = {}
+_clients_lock = threading.Lock()
+_session = None
+
+
+def get_session():
+    """Shared HTTP session (connection pool) used by all API clients"""
+
+    global _session
+
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
 def connect_api(account):
-    return Mastodon(access_token = f"{PREFS['user_dir']}/creds/{account['safe']}_usercred.secret", request_timeout = 10)
+    """Get the API client for an account
+
+    Clients are created once per account and reused for the whole run, so that
+    the credentials are only read once, HTTP connections are kept alive, and
+    the rate limit information (ratelimit_remaining etc) stays accurate.
+    """
+
+    with _clients_lock:
+        api = _clients.get(account['handle'])
+        if api is None:
+            api = Mastodon(
+                access_token = f"{PREFS['user_dir']}/creds/{account['safe']}_usercred.secret",
+                request_timeout = 10,
+                session = get_session()
+            )
+            _clients[account['handle']] = api
+    return api
 
 
 def validate_username(account):
+    """Check that the credentials match the configured account
+
+    Returns the authenticated account (verify_credentials), or False
+    """
+
     api = connect_api(account)
+    ratelimit.wait(account, api)
     user_data = api.account_verify_credentials()
     authenticated_username = user_data.username
 
     if authenticated_username != account['username']:
         msg = f"⚠️ WARNING for account {account['text']}: the username declared in 'prefs.json' ({account['username']}) does not match the authenticated username ({authenticated_username}). This will lead to inaccurate information saved in the database (activities attributed to the wrong account). You should either:\n\nFix your 'prefs.json' file by filling {authenticated_username} instead of {account['username']},\n\nOr restart the whole app initialization process, by deleting the 'creds/{account['safe']}*.secret' files and running app_init.py again. Make sure your are logged in with the correct account on {account['instance']} when authorizing the app.\n\nYou can revoke the app authorization on your {authenticated_username} account on the web by visiting 'Preferences > Account > Authorized apps' and clicking 'revoke' for {__APP_NAME__}."
-        log.err(msg, True)
+        log.err(msg, also_print=True)
         return False
 
-    return True
+    return user_data
 
 
 def api_limit(account):
@@ -43,156 +99,456 @@ def api_limit(account):
 
 def fetch_post_from_id(account, post_id, activity_type):
     log.info(f"fetch_post_from_id ({activity_type}): {post_id} - account {account['text']}")
+
+    post_uri = db.get_post_by_id(account, post_id)
+    if post_uri:
+        save_known_post(account, post_uri, activity_type, post_id)
+        return
+
+    if db.is_missing_post(account, 'parent', post_id):
+        log.info(f"  post {post_id} was not found recently; skipping")
+        return
+
     api = connect_api(account)
 
     try:
+        ratelimit.wait(account, api, ratelimit.CRAWL)
         status = api.status(post_id)
 
+    except MastodonNotFoundError as e:
+        log.err(f"  ERROR: {e}", also_print=True)
+        db.save_missing_post(account, 'parent', post_id, get_expiry(MISSING_POST_EXPIRY))
+        return
+
     except MastodonError as e:
-        log.err(f"  ERROR: {e}", True)
+        log.err(f"  ERROR: {e}", also_print=True)
         return
 
     log.debug(status)
     db.save_status(account, status, activity_type)
 
 
+def fetch_post_parents(account, reply_id, post_id, activity_type):
+    """Fetch the parent of a reply (post_id), and all its ancestors at once
+
+    The ancestors are labelled by their position in the chain:
+    X.parent, X.parent#2, X.parent#3...
+    Falls back to fetch_post_from_id() (one post at a time) if the context
+    of the reply is unavailable.
+    """
+
+    log.info(f"fetch_post_parents ({activity_type}): {post_id} - account {account['text']}")
+
+    post_uri = db.get_post_by_id(account, post_id)
+    if post_uri:
+        save_known_post(account, post_uri, activity_type, post_id)
+        return
+
+    if db.is_missing_post(account, 'parent', post_id):
+        log.info(f"  post {post_id} was not found recently; skipping")
+        return
+
+    api = connect_api(account)
+
+    try:
+        ratelimit.wait(account, api, ratelimit.CRAWL)
+        ancestors = api.status_context(reply_id).ancestors
+
+    except MastodonError as e:
+        log.warn(f"  Context of {reply_id} unavailable ({e}); fetching the parent alone")
+        ancestors = []
+
+    # the ancestors come oldest first; we start from the parent and go up,
+    # as long as each post is the parent of the previous one
+    chain = []
+    expected_id = post_id
+    for status in reversed(ancestors):
+        if str(status.id) != str(expected_id):
+            break
+        chain.append(status)
+        expected_id = status.in_reply_to_id
+
+    if not chain:
+        fetch_post_from_id(account, post_id, activity_type)
+        return
+
+    for status in chain:
+        if db.get_depth(activity_type) > PREFS['recursion_limit']:
+            log.warn(f"⛔ STOP. We don't want to go any deeper than that (PREFS['recursion_limit'] is {PREFS['recursion_limit']}).", also_print=True)
+            log.warn(f"  {activity_type}")
+            return
+
+        db.save_status(account, status, activity_type, follow_parents=False)
+        last_activity = activity_type
+        activity_type = db.get_related_activity(activity_type, 'parent')
+
+    oldest = chain[-1]
+    if oldest.in_reply_to_id:
+        # the context was truncated: we go on from the oldest ancestor we got
+        if db.get_depth(last_activity) < PREFS['recursion_limit']:
+            crawler.push(account, 'parent', (oldest.id, oldest.in_reply_to_id), activity_type)
+
+
 def fetch_post_by_url(account, post_url, activity_type):
     log.info(f"fetch_post_by_url ({activity_type}): {post_url} - account {account['text']}")
+
+    url_key = utils.get_post_url_key(post_url) or post_url
+
+    post = db.get_post_by_url(account, post_url)
+    if not post:
+        # another form of this link may have been resolved already
+        resolved_uri = db.get_link_resolution(url_key)
+        if resolved_uri:
+            post = db.get_post_by_url(account, resolved_uri)
+
+    if post:
+        post_uri, post_id = post
+        if post_id is not None:
+            save_known_post(account, post_uri, activity_type, post_id)
+            return
+        # in the archive, but its id on this instance is unknown: the search
+        # below gives it (and the post isn't saved again if it didn't change)
+        log.info(f"  {post_uri} is in the archive, but was never fetched from this instance")
+
+    if db.is_missing_post(account, 'link', url_key):
+        log.info(f"  {post_url} was not found recently; skipping")
+        return
+
     api = connect_api(account)
 
     try:
+        ratelimit.wait(account, api, ratelimit.CRAWL)
         result = api.search_v2(q = post_url, result_type = 'statuses')
 
     except MastodonError as e:
-        log.err(f"  ERROR: {e}", True)
+        log.err(f"  ERROR: {e}", also_print=True)
         return
 
     if result.statuses:
+        db.save_link_resolution(url_key, result.statuses[0].uri, get_expiry(LINK_RESOLUTION_EXPIRY))
         db.save_status(account, result.statuses[0], activity_type)
+    else:
+        db.save_missing_post(account, 'link', url_key, get_expiry(MISSING_POST_EXPIRY))
+
+
+def save_known_post(account, post_uri, activity_type, post_id):
+    """A related post is already in the archive: we only record the activity
+
+    Same as db.save_status() for a post that didn't change: the posts it
+    leads to are not fetched again.
+    """
+
+    log.info(f"  🟰 Post {post_uri} is already present in database; no need to fetch it.")
+    if not db.get_unique_activity(account, post_uri, activity_type):
+        db.save_activity_row(account, post_uri, activity_type, post_id)
+
+
+def get_expiry(days):
+    expires_at = datetime.now() + timedelta(days=days)
+    return expires_at.strftime('%Y-%m-%d %H:%M:%S')
 
 
-def fetch_posts(account, activity_type='posts'):
-    """Fetch various types of posts (activity_type) and saves them individually"""
-    log.info(f"fetch_posts ({activity_type}) - account {account['text']}", True)
+def fetch_posts(account, activity_type='posts', user=None, types=None):
+    """Fetch various types of posts (activity_type) and saves them individually
+
+    user: the authenticated account (see validate_username), if we have it
+    types: for activity_type == 'notification', the types of notifications
+    to fetch ('mention', 'poll'), all in one pass
+
+    Returns the number of posts fetched, by activity type
+    """
+    log.info(f"fetch_posts ({activity_type}) - account {account['text']}", also_print=True)
     api = connect_api(account)
 
-    if activity_type == 'mention':
-        try:
-            start_from = db.get_last_fetched_id(account, activity_type)
-            start_from = 0 if start_from is None else start_from
-            log.info(f"  start_from: {start_from}")
-            statuses = api.notifications(limit=PREFS['fetch_limit'], types=['mention'], min_id=start_from)
-        except MastodonError as e:
-            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", True)
-            return
+    # the notifications of each type are saved as an activity of this type,
+    # and they all share the same position (see get_checkpoint)
+    activity_types = types if activity_type == 'notification' else [activity_type]
+    counts = dict.fromkeys(activity_types, 0)
 
-    elif activity_type == 'poll':
+    if activity_type == 'notification':
         try:
-            start_from = db.get_last_fetched_id(account, activity_type)
-            start_from = 0 if start_from is None else start_from
+            # types enabled later on start from the beginning
+            start_from = min(int(get_checkpoint(account, t)) for t in types)
             log.info(f"  start_from: {start_from}")
-            statuses = api.notifications(limit=PREFS['fetch_limit'], types=['poll'], min_id=start_from)
+            ratelimit.wait(account, api)
+            statuses = api.notifications(limit=PREFS['fetch_limit'], types=types, min_id=start_from)
         except MastodonError as e:
-            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", True)
-            return
+            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", also_print=True)
+            return counts
 
     elif activity_type == 'bookmark':
         try:
-            start_from = db.get_app_state(account['handle'], 'bookmarks_pagination_prev')
-            start_from = 0 if start_from is None else start_from
+            start_from = get_checkpoint(account, activity_type)
             log.info(f"  start_from: {start_from}")
+            ratelimit.wait(account, api)
             statuses = api.bookmarks(limit=PREFS['fetch_limit'], min_id=start_from)
         except MastodonError as e:
-            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", True)
-            return
+            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", also_print=True)
+            return counts
 
     elif activity_type == 'favourite':
         try:
-            start_from = db.get_app_state(account['handle'], 'favourites_pagination_prev')
-            start_from = 0 if start_from is None else start_from
+            start_from = get_checkpoint(account, activity_type)
             log.info(f"  start_from: {start_from}")
+            ratelimit.wait(account, api)
             statuses = api.favourites(limit=PREFS['fetch_limit'], min_id=start_from)
         except MastodonError as e:
-            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", True)
-            return
+            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", also_print=True)
+            return counts
 
     else:
         activity_type = 'post'
+        activity_types = ['post']
+        counts = {'post': 0}
         try:
-            start_from = db.get_last_fetched_id(account)
-            start_from = 0 if start_from is None else start_from
+            start_from = get_checkpoint(account, activity_type)
             log.info(f"  start_from: {start_from}")
-            statuses = api.account_statuses(api.me(), limit=PREFS['fetch_limit'], min_id=start_from)
+            if user is not None:
+                me = user
+            else:
+                ratelimit.wait(account, api)
+                me = api.me()
+            ratelimit.wait(account, api)
+            statuses = api.account_statuses(me, limit=PREFS['fetch_limit'], min_id=start_from)
         except MastodonError as e:
-            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", True)
-            return
+            log.err(f"fetch_posts ({activity_type}) - ERROR: {e}", also_print=True)
+            return counts
 
-    count = 0
     no_content = 0
-    for i in __import__('itertools').count():
+    for i, statuses in enumerate(prefetch_pages(account, api, statuses)):
         log.info(f"LOOP {i}")
         api_limit(account)
 
-        if not statuses:
-            break
-
-        parse_statuses = reversed(statuses) if activity_type in {'post', 'mention', 'poll'} else statuses
+        parse_statuses = reversed(statuses) if activity_type in {'post', 'notification'} else statuses
 
         for status in parse_statuses:
-            if activity_type in {'mention', 'poll'} and not status.status:
+            status_activity = status.type if activity_type == 'notification' else activity_type
+            if status_activity not in counts:
+                # instances that ignore the 'types' filter
+                continue
+
+            if activity_type == 'notification' and not status.status:
                 notification_author = utils.get_handle(status.account.url) if status.account and status.account.url else '[unknown author]'
-                log.warn(f"  Post {status.id} ({activity_type}) by {notification_author} has no content (expired from instance cache?); skipping.")
-                log.debug(f"  Full JSON: {utils.to_json(status.__dict__)}")
+                log.warn(f"  Post {status.id} ({status_activity}) by {notification_author} has no content (expired from instance cache?); skipping.")
+                log.debug(lambda: f"  Full JSON: {utils.to_json(status.__dict__)}")
                 no_content += 1
                 continue
 
-            db.save_status(account, status, activity_type)
-            count += 1
+            db.save_status(account, status, status_activity)
+            counts[status_activity] = counts.get(status_activity, 0) + 1
+
+        # related posts (parents, links) found in this page
+        crawler.run(account)
 
-        log.debug(f"=> api.fetch_previous ({i})")
-        statuses = api.fetch_previous(statuses)
+        # one transaction per page, checkpoint included: if we are interrupted,
+        # the next run starts right after the last page saved
+        for t in activity_types:
+            save_checkpoint(account, t, statuses)
+        writer.flush(wait=False)
 
-    if activity_type == 'bookmark':
-        pagination_prev = api.bookmarks()._pagination_prev["min_id"]
-            # see https://github.com/halcy/Mastodon.py/issues/417
-        log.info(f'  pagination_prev: {pagination_prev}')
-        db.save_app_state(account['handle'], 'bookmarks_pagination_prev', pagination_prev)
+    if activity_type == 'post' and user is not None:
+        # all caught up (see has_new_posts)
+        db.save_app_state(account['handle'], 'posts_signature', get_posts_signature(user))
 
-    if activity_type == 'favourite':
-        pagination_prev = api.favourites()._pagination_prev["min_id"]
-            # see https://github.com/halcy/Mastodon.py/issues/417
-        log.info(f'  pagination_prev: {pagination_prev}')
-        db.save_app_state(account['handle'], 'favourites_pagination_prev', pagination_prev)
+    writer.flush()
 
     msg_no_content = f"\n  {no_content} {activity_type}{'s were' if no_content > 1 else ' was'} skipped (no content)." if no_content else ''
 
-    log.info(f"Done. {count} {activity_type}{'s' if count > 1 else ''} fetched.{msg_no_content}\n", True)
+    log.info(f"Done. {format_counts(counts)} fetched.{msg_no_content}\n", also_print=True)
+    return counts
+
+
+def get_checkpoint(account, activity_type):
+    """Where to start fetching {activity_type}: min_id of the next page"""
+
+    start_from = db.get_app_state(account['handle'], f'{activity_type}s_pagination_prev')
+    if start_from is None and activity_type in {'post', 'mention', 'poll'}:
+        # archives created before checkpoints existed
+        start_from = db.get_last_fetched_id(account, activity_type)
+    return 0 if start_from is None else start_from
+
+
+def save_checkpoint(account, activity_type, page):
+    """Save the position after a page of results (see get_checkpoint)"""
+
+    pagination_prev = getattr(page, '_pagination_prev', None)
+    if pagination_prev and pagination_prev.get('min_id') is not None:
+        log.info(f'  pagination_prev: {pagination_prev["min_id"]}')
+        db.save_app_state(account['handle'], f'{activity_type}s_pagination_prev', pagination_prev['min_id'])
+
+
+def prefetch_pages(account, api, statuses):
+    """Iterate over the pages of results, starting with {statuses}
+
+    The next pages are fetched (api.fetch_previous) in a separate thread,
+    up to PAGE_PREFETCH pages ahead, while the current one is being saved.
+    """
+
+    pages = queue.Queue(maxsize=PAGE_PREFETCH)
+    stop = threading.Event()
+    prefix = log.get_prefix()
+
+    def produce(page):
+        log.set_prefix(prefix)
+        i = 0
+        try:
+            while page and not stop.is_set():
+                put(page)
+                log.debug(f"=> api.fetch_previous ({i})")
+                ratelimit.wait(account, api)
+                page = api.fetch_previous(page)
+                i += 1
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    threading.Thread(target=produce, args=(statuses,), name='pages', daemon=True).start()
+
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+
+
+def fetch_account(account):
+    """Fetch all the enabled activity types for one account
+
+    Returns the number of items fetched for each activity type,
+    or None if the account was skipped
+    """
+
+    print("")
+    log.info(f"ACCOUNT: {account['text']}\n", also_print=True)
+
+    user = validate_username(account)
+    if not user:
+        log.err("❌ Mismatch between configured username and authenticated username. Skipping this account.", also_print=True)
+        return None
+
+    counts = {}
+    if has_new_posts(account, user):
+        counts.update(fetch_posts(account, user=user))
+    else:
+        log.info("No new post since the last run; skipping.\n", also_print=True)
+        counts['post'] = 0
+
+    if PREFS['fetch_favourites']:
+        counts.update(fetch_posts(account, 'favourite'))
+    if PREFS['fetch_bookmarks']:
+        counts.update(fetch_posts(account, 'bookmark'))
+
+    # mentions and polls: one single pass over the notifications
+    types = get_notification_types()
+    if types:
+        counts.update(fetch_posts(account, 'notification', types=types))
+
+    return counts
+
+
+def get_notification_types():
+    """Types of notifications we save (as activities of the same name)"""
+    return [t for t, pref in (('mention', 'fetch_mentions'), ('poll', 'fetch_polls')) if PREFS[pref]]
+
+
+def has_new_posts(account, user):
+    """Whether the account may have posted since the last run
+
+    Compares the number of posts and the date of the last one (from
+    verify_credentials, which we call anyway) with those of the last run:
+    if they didn't change, fetching the posts would be a wasted API call.
+    """
+
+    signature = db.get_app_state(account['handle'], 'posts_signature')
+    return signature != get_posts_signature(user)
+
+
+def get_posts_signature(user):
+    return f"{user.statuses_count} {user.last_status_at}"
+
+
+def fetch_account_parallel(account):
+    """fetch_account(), for a worker thread: log lines are prefixed with the account"""
+
+    log.set_prefix(f"[{account['handle']}] ")
+    try:
+        return fetch_account(account)
+    except Exception as e:
+        log.err(f"❌ Unexpected error, skipping the rest of this account: {type(e).__name__}: {e}", also_print=True)
+        return None
+    finally:
+        log.set_prefix('')
 
 
 def fetch_all():
     print("")
     nb = len(ACCOUNTS)
-    log.info(f"Starting {__APP_NAME__} v.{__VERSION__} ---- {nb} account{'(s)' if nb > 1 else ''} configured", True)
+    log.info(f"Starting {__APP_NAME__} v.{__VERSION__} ---- {nb} account{'(s)' if nb > 1 else ''} configured", also_print=True)
 
-    for account in ACCOUNTS:
-        print("")
-        log.info(f"ACCOUNT: {account['text']}\n", True)
+    # create the tables added in newer versions, if needed
+    db.init_db()
 
-        if not validate_username(account):
-            log.err("❌ Mismatch between configured username and authenticated username. Skipping this account.", True)
-            continue
+    results = fetch_accounts()
 
-        fetch_posts(account)
+    crawler.shutdown()
+    download.shutdown()
+    writer.stop()
+    pack.close()
+    db.close_all()
 
-        if PREFS['fetch_favourites']:
-            fetch_posts(account, 'favourite')
-        if PREFS['fetch_bookmarks']:
-            fetch_posts(account, 'bookmark')
-        if PREFS['fetch_mentions']:
-            fetch_posts(account, 'mention')
-        if PREFS['fetch_polls']:
-            fetch_posts(account, 'poll')
+    print("")
+    log_summary(results)
 
     print("")
-    log.info("✅ End of script\n", True)
+    log.info("✅ End of script\n", also_print=True)
+
+
+def fetch_accounts():
+    """Fetch all the configured accounts once; returns the result of fetch_account() for each"""
+
+    workers = min(PREFS['account_workers'], len(ACCOUNTS))
+    if workers > 1:
+        log.info(f"Fetching {workers} accounts in parallel", also_print=True)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='account') as pool:
+            results = list(pool.map(fetch_account_parallel, ACCOUNTS))
+    else:
+        results = [fetch_account(account) for account in ACCOUNTS]
+
+    if PREFS['defer_attachments']:
+        media.drain()
+
+    return results
+
+
+def log_summary(results):
+    log.info("Summary:", also_print=True)
+
+    totals = {}
+    for account, counts in zip(ACCOUNTS, results):
+        if counts is None:
+            log.info(f"  {account['handle']}: skipped", also_print=True)
+            continue
+
+        for activity_type, count in counts.items():
+            totals[activity_type] = totals.get(activity_type, 0) + count
+        log.info(f"  {account['handle']}: {format_counts(counts)}", also_print=True)
+
+    if len(ACCOUNTS) > 1:
+        log.info(f"  Total: {format_counts(totals)}", also_print=True)
+
 
+def format_counts(counts):
+    return ', '.join(f"{count} {activity_type}{'s' if count > 1 else ''}" for activity_type, count in counts.items())
@@ -2,6 +2,7 @@ import os
 from mastodon import Mastodon
 
 import src.db as db
+import src.writer as writer
 
 from . import __APP_NAME__
 from . import __VERSION__
@@ -72,6 +73,9 @@ def main():
         register_app(account)
         authorize_app(account)
 
+    writer.stop()
+    db.close_all()
+
     print("\nAnd we're done! :)\n")
 
 
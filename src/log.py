@@ -1,81 +1,164 @@
+import atexit
 import logging
+import logging.handlers
 import os
-import time
+import queue
+import threading
 
 from . import __APP_NAME__
 from . import PREFS
 
 LOG_PREFIX = f'{__APP_NAME__}-run'
 
-def purge_logs():
-    limit = int(PREFS['log_history_limit']) - 1
-    if limit < 0:
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+# per-thread prefix for all messages (e.g. the account, when several accounts
+# are fetched in parallel)
+_context = threading.local()
+
+_logger = None
+_listener = None
+_logger_lock = threading.Lock()
+
+
+def set_prefix(prefix):
+    _context.prefix = prefix
+
+
+def get_prefix():
+    return getattr(_context, 'prefix', '')
+
+
+def get_logger():
+    """The logger, configured on first use
+
+    Messages are queued, and written to the log file by a background thread
+    (QueueListener). The file is rotated once it reaches
+    PREFS['log_max_size'] MB; PREFS['log_history_limit'] rotated files are
+    kept.
+    """
+
+    global _logger, _listener
+
+    with _logger_lock:
+        if _logger is not None:
+            return _logger
+
+        logs_dir = f"{PREFS['user_dir']}/logs"
+        os.makedirs(logs_dir, exist_ok=True)
+        filename = f"{logs_dir}/{LOG_PREFIX}.log"
+
+        max_size = float(PREFS['log_max_size'])
+        history = int(PREFS['log_history_limit'])
+        if max_size > 0 and history > 0:
+            handler = logging.handlers.RotatingFileHandler(filename, maxBytes=int(max_size * 1024**2), backupCount=history, encoding='utf-8')
+        else:
+            # no rotation: a single file, never deleted
+            handler = logging.FileHandler(filename, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, handler)
+        _listener.start()
+
+        # on the root logger, so that messages of the libraries we use
+        # (Mastodon.py, requests...) are written too
+        root = logging.getLogger()
+        root.setLevel(LOG_LEVELS.get(PREFS['log_level'], logging.WARNING))
+        root.addHandler(QueueHandler(records))
+
+        _logger = logging.getLogger(__name__)
+        purge_legacy_logs(logs_dir)
+        return _logger
+
+
+def purge_legacy_logs(logs_dir):
+    """Delete the oldest per-run log files written by older versions
+
+    (LAMA-run-{date}-{time}.log) so that at most PREFS['log_history_limit']
+    of them are left, like these versions did.
+    """
+
+    limit = int(PREFS['log_history_limit'])
+    if limit <= 0:
         return
 
-    all_files = os.listdir(f"{PREFS['user_dir']}/logs")
-    app_logs = [f"{PREFS['user_dir']}/logs/{file}" for file in all_files if file.startswith(LOG_PREFIX)]
-    app_logs = [file for file in app_logs if os.path.isfile(file)]
-
-    if len(app_logs) > limit:
-        info("Purging old log files")
-        delete_files = sorted([os.path.abspath(log) for log in app_logs], key=os.path.getctime)[0:(0-limit)]
-
-        for delete_file in delete_files:
-            try:
-                os.remove(delete_file)
-                info(f"  '{delete_file}' deleted")
-            except Exception as e:
-                error_msg = f"{type(e).__name__}: {str(e)}"
-                err(f"❌ Failed to delete expired log file ({delete_file})", True)
-                err(f"  {error_msg}", True)
-
-
-def log(txt, type='info', also_print=False):
-    logger = logging.getLogger(__name__)
-
-    lv = logging.WARNING
-    match PREFS['log_level']:
-        case 'debug':
-            lv = logging.DEBUG
-        case 'info':
-            lv = logging.INFO
-        case 'warning':
-            lv = logging.WARNING
-        case 'critical':
-            lv = logging.CRITICAL
-
-    timestr = time.strftime("%Y%m%d-%H%M%S")
-    logging.basicConfig(
-        filename=f"{PREFS['user_dir']}/logs/{LOG_PREFIX}-{timestr}.log",
-        level=lv,
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        encoding='utf-8'
-    )
-
-    match type:
-        case 'debug':
-            logger.debug(txt)
-        case 'info':
-            logger.info(txt)
-        case 'warning':
-            logger.warning(txt)
-        case 'error':
-            logger.error(txt)
+    legacy = [f"{logs_dir}/{file}" for file in os.listdir(logs_dir) if file.startswith(f"{LOG_PREFIX}-") and file.endswith('.log')]
+    legacy = sorted([file for file in legacy if os.path.isfile(file)], key=os.path.getctime)
 
-    if also_print:
-        print(txt)
+    for delete_file in legacy[:-limit]:
+        try:
+            os.remove(delete_file)
+            _logger.info(f"Old log file '{delete_file}' deleted")
+        except OSError as e:
+            _logger.error(f"❌ Failed to delete expired log file ({delete_file}): {type(e).__name__}: {e}")
+
+
+def _stop_listener():
+    """Write what's still queued when the script ends"""
+
+    if _listener is not None:
+        _listener.stop()
+
+
+# registered on import, before the hooks of the modules that log (e.g.
+# writer.stop): atexit runs them in reverse order, so their messages are
+# still written
+atexit.register(_stop_listener)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # same as the default, without copying the record: we don't use it
+        # after this
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
 
 
-def debug(txt, also_print=False):
-    log(txt, 'debug', also_print)
+def log(txt, *args, type='info', also_print=False):
+    """Write a message to the log file (and to the console if also_print)
+
+    To save the cost of building messages that are not written (e.g. debug
+    messages, with the default log level), txt can be a %-style format
+    string with its args, or a callable returning the message; they are only
+    rendered if the message is written.
+    """
+
+    logger = get_logger()
+    level = LOG_LEVELS[type]
+    if not also_print and not logger.isEnabledFor(level):
+        return
+
+    if callable(txt):
+        txt = txt()
+
+    prefix = get_prefix()
+    if prefix:
+        txt = f"{prefix}{txt}"
+
+    logger.log(level, txt, *args)
+
+    if also_print:
+        print(txt % args if args else txt)
+
 
-def info(txt, also_print=False):
-    log(txt, 'info', also_print)
+def debug(txt, *args, also_print=False):
+    log(txt, *args, type='debug', also_print=also_print)
 
-def warn(txt, also_print=False):
-    log(txt, 'warning', also_print)
+def info(txt, *args, also_print=False):
+    log(txt, *args, type='info', also_print=also_print)
 
-def err(txt, also_print=False):
-    log(txt, 'error', also_print)
+def warn(txt, *args, also_print=False):
+    log(txt, *args, type='warning', also_print=also_print)
 
+def err(txt, *args, also_print=False):
+    log(txt, *args, type='error', also_print=also_print)
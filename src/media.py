@@ -0,0 +1,101 @@
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+
+import src.db as db
+import src.download as download
+import src.log as log
+import src.save as save
+import src.writer as writer
+
+from . import PREFS
+
+
+# Deferred attachments (PREFS['defer_attachments']).
+#
+# While fetching, attachments are only recorded in the 'pending_media' table
+# (and marked as PENDING in the 'attachments' column of the post). They are
+# downloaded later by drain(), within a size and time budget, so that the text
+# archive is done quickly and the media downloads are spread over several runs.
+
+PENDING = 'pending'
+
+MEDIA_RETRY_DELAY = 15      # minutes before the first retry, doubled for each failure
+MEDIA_MAX_ATTEMPTS = 8      # after that, we give up and save the error
+
+
+def drain():
+    """Download pending attachments, within the configured budget"""
+
+    writer.flush()
+
+    budget_size = PREFS['media_budget_size'] * 1024**2
+    budget_time = PREFS['media_budget_time'] * 60
+    newest_first = PREFS['media_order'] == 'newest'
+
+    pending = db.get_pending_media(newest_first)
+    if not pending:
+        return
+
+    log.info(f"Downloading pending attachments ({len(pending)} in queue)", also_print=True)
+
+    start = time.monotonic()
+    size = 0
+    count = 0
+    failed = 0
+    running = set()
+
+    def budget_left():
+        if budget_size and size >= budget_size:
+            return False
+        if budget_time and time.monotonic() - start >= budget_time:
+            return False
+        return True
+
+    pending = iter(pending)
+    while True:
+        # keep the download pool busy, as long as we are within budget
+        while budget_left() and len(running) < max(1, PREFS['download_workers']):
+            row = next(pending, None)
+            if row is None:
+                break
+            running.add(download.submit(drain_one, row, url=next(iter(json.loads(row['urls'])), None)))
+
+        if not running:
+            break
+
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            ok, nb_bytes = future.result()
+            size += nb_bytes
+            count += 1 if ok else 0
+            failed += 0 if ok else 1
+
+    writer.flush()
+
+    left = db.count_pending_media()
+    log.info(f"Done. {count} attachment{'s' if count > 1 else ''} downloaded ({size / 1024**2:.1f} MB), {failed} failed; {left} still pending.\n", also_print=True)
+
+
+def drain_one(row):
+    """Download one pending attachment; returns (ok, size in bytes)"""
+
+    urls = json.loads(row['urls'])
+    ok, txt, blob = save.download_attachment(urls, row['path'], row['post_uri'], row['idx'])
+
+    if ok:
+        db.save_attachment_entry(row['post_uri'], row['idx'], [txt, row['description']], blob)
+        db.delete_pending_media(row['post_uri'], row['idx'])
+        return (True, os.path.getsize(f"{PREFS['user_dir']}/data/{txt}"))
+
+    attempts = row['attempts'] + 1
+    if attempts >= MEDIA_MAX_ATTEMPTS:
+        log.err(f"  ❌ Giving up on attachment {row['idx']} of {row['post_uri']} after {attempts} attempts", also_print=True)
+        db.save_attachment_entry(row['post_uri'], row['idx'], [txt, row['description']])
+        db.delete_pending_media(row['post_uri'], row['idx'])
+    else:
+        next_attempt = datetime.now() + timedelta(minutes=MEDIA_RETRY_DELAY * 2 ** (attempts - 1))
+        db.retry_pending_media(row['post_uri'], row['idx'], attempts, next_attempt.strftime('%Y-%m-%d %H:%M:%S'), txt)
+    return (False, 0)
@@ -0,0 +1,266 @@
+import glob
+import gzip
+import json
+import os
+import threading
+
+import src.log as log
+import src.utils as utils
+
+from . import PREFS
+
+
+# Packed JSON archive (PREFS['json_format'] == 'packed').
+#
+# Instead of one file per post (data/json/{account}/{type}s/{year}/{month}/
+# {author}_{id}.json), the posts of each account, type and month are appended
+# as compact JSON lines to a single segment:
+#
+#   data/json/{account}/{type}s/{year}/{month}.jsonl      lines not compressed yet
+#   data/json/{account}/{type}s/{year}/{month}.jsonl.gz   compressed blocks
+#   data/json/{account}/{type}s/{year}/{month}.idx        index of the blocks
+#
+# When the .jsonl reaches PACK_BLOCK_SIZE, and at the end of each run, its
+# lines are compressed as a new gzip member (block) at the end of the .jsonl.gz
+# (a file made of several gzip members is still a valid gzip file: zcat reads
+# it as a whole). The .idx has one line per post, tab separated:
+#
+#   {author}_{id}  offset and size of the block  offset and size of the line in the block
+#
+# so that one post can be read without decompressing the whole segment. If a
+# post is saved more than once (edits), the last line wins.
+
+PACK_BLOCK_SIZE = 1024**2       # uncompressed size of a block
+PACK_COMPRESS_LEVEL = 6
+
+_segments = {}
+_lock = threading.Lock()
+
+
+class Segment:
+    """Lines of a segment not compressed yet
+
+    The .jsonl file is only opened to append a line: a backfill can touch
+    hundreds of segments (one per month), and each line is on disk as soon
+    as it is saved, even if the run is interrupted.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+
+        self.keys = self.recover()
+        self.size = os.path.getsize(f"{base}.jsonl") if os.path.exists(f"{base}.jsonl") else 0
+
+    def recover(self):
+        """Keys of the lines left by a run that didn't end properly"""
+
+        lines = read_lines(f"{self.base}.jsonl")
+        keys = []
+        valid = []
+        for line in lines:
+            try:
+                keys.append(get_key(json.loads(line)))
+                valid.append(line)
+            except ValueError:
+                # interrupted while writing this line
+                log.warn(f"⚠️ Incomplete line dropped from {self.base}.jsonl", also_print=True)
+
+        if len(valid) != len(lines):
+            with open(f"{self.base}.jsonl", 'w', encoding='utf-8') as f:
+                f.writelines(f"{line}\n" for line in valid)
+        return keys
+
+    def append(self, key, js):
+        line = (js + '\n').encode('utf-8')
+        with open(f"{self.base}.jsonl", 'ab') as f:
+            f.write(line)
+        self.keys.append(key)
+        self.size += len(line)
+
+        if self.size >= PACK_BLOCK_SIZE:
+            self.rotate()
+
+    def rotate(self):
+        """Compress the pending lines as a new block"""
+
+        self.close()
+        self.size = 0
+
+    def close(self):
+        if not os.path.exists(f"{self.base}.jsonl"):
+            return
+        with open(f"{self.base}.jsonl", 'rb') as f:
+            block = f.read()
+        if block:
+            append_block(self.base, self.keys, block)
+        os.remove(f"{self.base}.jsonl")
+        self.keys = []
+
+
+def get_base(account_safe, activity_type, year, month):
+    return f"{PREFS['user_dir']}/data/json/{account_safe}/{activity_type}s/{year}/{month}"
+
+
+def get_key(data):
+    """Same name as the JSON file of this post ("{author}_{id}")"""
+
+    return f"{utils.get_handle(data['account']['url'], True)}_{data['id']}"
+
+
+def append(base, key, js):
+    """Add one post (compact JSON) to a segment"""
+
+    with _lock:
+        segment = _segments.get(base)
+        if segment is None:
+            segment = _segments[base] = Segment(base)
+        segment.append(key, js)
+
+
+def close():
+    """Compress the lines still pending; must be called at the end of a run"""
+
+    with _lock:
+        for segment in _segments.values():
+            segment.close()
+        _segments.clear()
+
+
+def append_block(base, keys, block):
+    """Compress lines ({block}, bytes) at the end of a segment, and index them"""
+
+    data = gzip.compress(block, compresslevel=PACK_COMPRESS_LEVEL, mtime=0)
+
+    with open(f"{base}.jsonl.gz", 'ab') as f:
+        offset = f.tell()
+        f.write(data)
+
+    index = []
+    start = 0
+    for key in keys:
+        end = block.index(b'\n', start)
+        index.append(f"{key}\t{offset}\t{len(data)}\t{start}\t{end - start}\n")
+        start = end + 1
+
+    with open(f"{base}.idx", 'a', encoding='utf-8') as f:
+        f.writelines(index)
+
+
+def read(base, key):
+    """JSON of one post of a segment (string); None if not found"""
+
+    # the lines not compressed yet are the most recent ones
+    found = None
+    for line in read_lines(f"{base}.jsonl"):
+        if get_key(json.loads(line)) == key:
+            found = line
+    if found is not None:
+        return found
+
+    entry = None
+    if os.path.exists(f"{base}.idx"):
+        with open(f"{base}.idx", encoding='utf-8') as f:
+            for line in f:
+                if line.startswith(f"{key}\t"):
+                    entry = line
+
+    if entry is None:
+        return None
+
+    _, offset, size, start, length = entry.split('\t')
+    with open(f"{base}.jsonl.gz", 'rb') as f:
+        f.seek(int(offset))
+        block = gzip.decompress(f.read(int(size)))
+    return block[int(start):int(start) + int(length)].decode('utf-8')
+
+
+def read_segment(base):
+    """All the posts of a segment, in the order they were saved: [(key, JSON)]"""
+
+    posts = []
+
+    if os.path.exists(f"{base}.idx"):
+        blocks = {}
+        with open(f"{base}.jsonl.gz", 'rb') as gz, open(f"{base}.idx", encoding='utf-8') as idx:
+            for line in idx:
+                key, offset, size, start, length = line.rstrip('\n').split('\t')
+                if offset not in blocks:
+                    gz.seek(int(offset))
+                    blocks = {offset: gzip.decompress(gz.read(int(size)))}
+                block = blocks[offset]
+                posts.append((key, block[int(start):int(start) + int(length)].decode('utf-8')))
+
+    for line in read_lines(f"{base}.jsonl"):
+        posts.append((get_key(json.loads(line)), line))
+
+    return posts
+
+
+def read_lines(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def convert(json_format):
+    """Convert the JSON archive (data/json) to the given format ('files' or 'packed')
+
+    One-off command, after changing PREFS['json_format'].
+    """
+
+    json_dir = f"{PREFS['user_dir']}/data/json"
+    log.info(f"Converting the JSON archive to '{json_format}'", also_print=True)
+
+    count = 0
+    if json_format == 'packed':
+        # data/json/{account}/{type}s/{year}/{month}/{author}_{id}.json
+        for month_dir in sorted(glob.glob(f"{glob.escape(json_dir)}/*/*/*/*/")):
+            files = sorted(glob.glob(f"{glob.escape(month_dir)}*.json"), key=os.path.getmtime)
+            if not files:
+                continue
+
+            base = month_dir.rstrip('/')
+            for filename in files:
+                with open(filename, encoding='utf-8') as f:
+                    js = json.dumps(json.loads(f.read()), ensure_ascii=False)
+                append(base, os.path.basename(filename)[:-5], js)
+            close()
+
+            # the packed segment is complete: the files can go
+            for filename in files:
+                os.remove(filename)
+            remove_empty_dir(month_dir)
+
+            count += len(files)
+            log.info(f"  {base[len(json_dir) + 1:]}: {len(files)} posts", also_print=True)
+
+    elif json_format == 'files':
+        bases = {filename.rsplit('.', 2 if filename.endswith('.jsonl.gz') else 1)[0] for filename in glob.glob(f"{glob.escape(json_dir)}/*/*/*/*.*")}
+        for base in sorted(bases):
+            posts = read_segment(base)
+            os.makedirs(base, exist_ok=True)
+            for key, js in posts:
+                with open(f"{base}/{key}.json", 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(json.loads(js), ensure_ascii=False, indent=4))
+
+            for ext in ('.jsonl', '.jsonl.gz', '.idx'):
+                if os.path.exists(f"{base}{ext}"):
+                    os.remove(f"{base}{ext}")
+
+            count += len(posts)
+            log.info(f"  {base[len(json_dir) + 1:]}: {len(posts)} posts", also_print=True)
+
+    else:
+        log.err(f"❌ Unknown JSON format '{json_format}' (expected 'files' or 'packed')", also_print=True)
+        return
+
+    log.info(f"Done. {count} posts converted.", also_print=True)
+
+
+def remove_empty_dir(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
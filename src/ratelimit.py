@@ -0,0 +1,78 @@
+import threading
+import time
+
+import src.log as log
+
+from . import PREFS
+
+
+# Rate limit aware scheduling of API calls.
+#
+# Mastodon tells us, with each response, how many calls we have left
+# (ratelimit_remaining) until the limit is reset (ratelimit_reset). Instead of
+# running into the limit and then being blocked until the reset, we space out
+# the calls so that the remaining budget lasts until the reset.
+#
+# A part of the budget (PREFS['ratelimit_reserve'], in % of the limit) is kept
+# for the main timelines (CORE): the related posts (CRAWL: parents, links) can
+# only use what's left above it.
+
+CORE = 'core'
+CRAWL = 'crawl'
+
+PACE_THRESHOLD = 0.5    # no pacing as long as more than half of the budget is left
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def wait(account, api, priority=CORE):
+    """Wait until we can make one more API call for this account
+
+    Must be called right before each API call.
+    """
+
+    with _states_lock:
+        state = _states.get(account['handle'])
+        if state is None:
+            state = {'lock': threading.Lock(), 'lastcall': None, 'remaining': None, 'reset': 0, 'next': {}}
+            _states[account['handle']] = state
+
+    with state['lock']:
+        now = time.time()
+
+        # sync with the headers of the last response received, then keep
+        # counting the calls we make ourselves (several threads may use the
+        # same account)
+        if state['lastcall'] != api.ratelimit_lastcall:
+            state['lastcall'] = api.ratelimit_lastcall
+            state['remaining'] = api.ratelimit_remaining
+            state['reset'] = api.ratelimit_reset
+
+        if state['reset'] <= now:
+            # new window: we don't know the budget yet, Mastodon.py assumes a full one
+            state['remaining'] = api.ratelimit_limit
+            state['reset'] = now
+
+        limit = api.ratelimit_limit
+        reserve = limit * PREFS['ratelimit_reserve'] / 100 if priority == CRAWL else 0
+        budget = state['remaining'] - reserve
+        window = state['reset'] - now
+        last = state['next'].get(priority, 0)
+
+        if budget < 1:
+            # nothing left for this priority: wait for the reset
+            start = max(last, state['reset'])
+            log.warn(f"⏳ Rate limit: {state['remaining']} calls left for {account['handle']} ({priority}), waiting {start - now:.0f}s for the reset")
+        else:
+            if budget < limit * PACE_THRESHOLD:
+                # spread the remaining calls until the reset
+                start = max(now, last + window / budget)
+            else:
+                start = now
+            state['remaining'] -= 1
+
+        state['next'][priority] = start
+
+    if start > now:
+        time.sleep(start - now)
@@ -0,0 +1,120 @@
+import json
+from datetime import datetime
+
+from mastodon import MastodonError, MastodonNotFoundError, MastodonVersionError
+
+import src.db as db
+import src.fetch as f
+import src.log as log
+import src.ratelimit as ratelimit
+import src.utils as utils
+import src.writer as writer
+
+from . import ACCOUNTS
+from . import PREFS
+
+
+# Posts already saved are never fetched again by the normal runs (which only
+# fetch what's newer than the last run), so edits made later, or the results
+# of polls, are not in the archive. The 'refresh' command fetches them again,
+# REFRESH_BATCH_SIZE at a time, and saves the ones that changed.
+
+REFRESH_BATCH_SIZE = 20     # max. number of ids for GET /api/v1/statuses
+
+
+def run(days=None):
+    """Check the saved posts for changes
+
+    days: only the posts created in the last {days} days; otherwise, the
+    posts that were checked the longest time ago
+    """
+
+    writer.flush()
+    started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    for account in ACCOUNTS:
+        print("")
+        log.info(f"ACCOUNT: {account['text']}\n", also_print=True)
+
+        if not f.validate_username(account):
+            log.err("❌ Mismatch between configured username and authenticated username. Skipping this account.", also_print=True)
+            continue
+
+        refresh_account(account, started_at, days)
+
+
+def refresh_account(account, started_at, days=None):
+    posts = db.get_posts_to_refresh(account, started_at, days, PREFS['refresh_limit'])
+    log.info(f"Refreshing {len(posts)} post{'s' if len(posts) > 1 else ''}", also_print=True)
+
+    api = f.connect_api(account)
+    batched = True
+    changed = 0
+    missing = 0
+
+    for i in range(0, len(posts), REFRESH_BATCH_SIZE):
+        batch = posts[i:i + REFRESH_BATCH_SIZE]
+        ids = [post_id for post_id, _, _, _ in batch]
+
+        if batched:
+            try:
+                ratelimit.wait(account, api)
+                statuses = api.statuses(ids)
+            except (MastodonVersionError, MastodonNotFoundError) as e:
+                # instances older than Mastodon 4.3
+                log.warn(f"  Batched fetch not available ({e}); fetching posts one by one", also_print=True)
+                batched = False
+            except MastodonError as e:
+                log.err(f"  ERROR: {e}", also_print=True)
+                continue
+
+        if not batched:
+            statuses = fetch_one_by_one(account, api, ids)
+
+        by_id = {str(status.id): status for status in statuses}
+
+        for post_id, post_uri, edited_at, poll in batch:
+            status = by_id.get(str(post_id))
+            if status is None:
+                # deleted, or not visible anymore: we keep what we have
+                log.info(f"  Post {post_uri} not found")
+                missing += 1
+                db.save_refreshed(post_uri)
+            elif has_changed(status, edited_at, poll):
+                db.save_status(account, status, 'refresh', refresh=True)
+                changed += 1
+            else:
+                db.save_refreshed(post_uri)
+
+        # one transaction per batch
+        writer.flush(wait=False)
+
+    writer.flush()
+
+    log.info(f"Done. {changed} post{'s' if changed > 1 else ''} updated, {missing} not found.\n", also_print=True)
+
+
+def fetch_one_by_one(account, api, ids):
+    statuses = []
+    for post_id in ids:
+        try:
+            ratelimit.wait(account, api)
+            statuses.append(api.status(post_id))
+        except MastodonNotFoundError:
+            pass
+        except MastodonError as e:
+            log.err(f"  ERROR: {e}", also_print=True)
+    return statuses
+
+
+def has_changed(status, edited_at, poll):
+    """Whether a post differs from what's saved (new edit, or poll results)"""
+
+    # dates are stored as text in the database
+    if str(edited_at) != str(status.edited_at):
+        return True
+
+    if status.get('poll'):
+        return json.loads(utils.to_json(status.poll)) != (json.loads(poll) if poll else None)
+
+    return False
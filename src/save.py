@@ -1,14 +1,32 @@
+import hashlib
 import os
+import shutil
 import urllib.request
 
+import src.blobs as blobs
+import src.db as db
+import src.download as download
 import src.log as log
+import src.media as media
+import src.pack as pack
 import src.utils as utils
 
 from . import PREFS
 
 
-def save_to_json (account, data, activity_type):
-    """Save raw fetched data to JSON file"""
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+def save_to_json (account, data, activity_type, payload=None):
+    """Save raw fetched data to JSON file
+
+    payload: utils.Payload of data, if it was already serialized
+    """
 
     id = data.id
     created_year = data.created_at.year
@@ -20,16 +38,32 @@ def save_to_json (account, data, activity_type):
     if '.link' in activity_type:
         activity_type = 'link'
 
+    payload = payload or utils.Payload(data)
+
+    if PREFS['json_format'] == 'packed':
+        base = pack.get_base(account['safe'], activity_type, created_year, created_month)
+        pack.append(base, f"{author}_{id}", payload.compact())
+        return
+
     filename = f"{PREFS['user_dir']}/data/json/{account['safe']}/{activity_type}s/{created_year}/{created_month}/{author}_{id}.json"
     os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-    js = utils.to_json(data.__dict__, True)
+    js = payload.indented()
 
     with open(filename, 'w', encoding='utf-8') as f:
         f.write(js)
 
 
-def save_attachments(account, status):
+def save_attachments(account, status, saved_attachments=None):
+    """Queue the attachments of a post for download
+
+    saved_attachments: attachments already saved for a previous version of
+    this post (see db.get_saved_attachments); those that didn't change are
+    not downloaded again.
+
+    Returns a list of Futures (one per attachment), see collect_attachments();
+    each one gives [path or error, description, blob or None]
+    """
 
     if utils.post_is_mine(account, status.account.url):
         if not PREFS['download_own_attachments']:
@@ -38,90 +72,298 @@ def save_attachments(account, status):
     elif not PREFS['download_others_attachments']:
         return []
 
+    saved_attachments = saved_attachments or {}
+    attachments = status.get('media_attachments') or []
+    unchanged = [get_unchanged_attachment(att, idx, saved_attachments) for idx, att in enumerate(attachments)]
+
+    # kept files that moved to another position (e.g. media inserted in front)
+    # get the path of their new position before any download can overwrite it
+    paths = move_attachments(status, unchanged)
+    remove_previous(status, unchanged, paths, saved_attachments)
+
     r = []
-    if status.get('media_attachments'):
-        for idx, att in enumerate(status.get('media_attachments', [])):
-            att_data = save_attachment(att, idx, status)
-            r.append(att_data)
+    for idx, att in enumerate(attachments):
+        saved = unchanged[idx]
+        desc = att['description'] if att['description'] else ""
+        if saved:
+            path = paths.get(idx, saved['entry'][0])
+            log.info(f"  attachment {idx} of {status.uri} didn't change; keeping {path}")
+            if path == media.PENDING:
+                # the description is written by media.drain()
+                db.save_pending_description(status.uri, idx, desc)
+            blob = saved['blob'] if PREFS['media_dedupe'] else None
+            r.append(download.done([path, desc, blob]))
+        elif PREFS['defer_attachments']:
+            # downloaded later, see media.drain()
+            db.save_pending_media(status.uri, idx, get_attachment_urls(att), get_attachment_path(status, idx), desc, status.created_at)
+            r.append(download.done([media.PENDING, desc, None]))
+        else:
+            r.append(download.submit(save_attachment, att, idx, status, url=next(iter(get_attachment_urls(att)), None)))
     return r
 
 
+def move_attachments(status, unchanged):
+    """Give the kept files that changed position the path of their new position
+
+    Returns {idx: new path}. All the files are linked (or copied) under a
+    temporary name first, so that swapping two attachments works too. The
+    ones that can't be moved are removed from {unchanged} (downloaded again).
+    """
+
+    data_dir = f"{PREFS['user_dir']}/data"
+    moves = []
+    for idx, saved in enumerate(unchanged):
+        if not saved or saved['idx'] == idx or saved['entry'][0] == media.PENDING:
+            continue
+
+        old_path = saved['entry'][0]
+        path = get_attachment_path(status, idx) + os.path.splitext(old_path)[1]
+        tmp = f"{data_dir}/{path}.{idx}.tmp"
+        try:
+            os.makedirs(os.path.dirname(tmp), exist_ok=True)
+            try:
+                os.link(f"{data_dir}/{old_path}", tmp)
+            except OSError:
+                shutil.copy2(f"{data_dir}/{old_path}", tmp)
+            moves.append((idx, tmp, path))
+        except OSError as e:
+            log.warn(f"  ⚠️ Could not move {old_path} to position {idx} ({e}); downloading it again", also_print=True)
+            unchanged[idx] = None
+
+    paths = {}
+    for idx, tmp, path in moves:
+        os.replace(tmp, f"{data_dir}/{path}")
+        paths[idx] = path
+    return paths
+
+
+def remove_previous(status, unchanged, paths, saved_attachments):
+    """Delete what the previous version of a post left and isn't used anymore
+
+    That is the files of the attachments that were removed (or replaced, or
+    moved: the file at their old path), and the pending downloads of the
+    positions that don't hold a pending attachment anymore.
+    """
+
+    data_dir = f"{PREFS['user_dir']}/data"
+    kept = {idx: paths.get(idx, saved['entry'][0]) for idx, saved in enumerate(unchanged) if saved}
+    kept_paths = set(kept.values())
+
+    for saved in saved_attachments.values():
+        idx = saved['idx']
+        path = saved['entry'][0]
+
+        if path == media.PENDING:
+            # a new attachment deferred at the same position replaces the row
+            queued_again = PREFS['defer_attachments'] and idx < len(unchanged) and unchanged[idx] is None
+            if kept.get(idx) != media.PENDING and not queued_again:
+                db.delete_pending_media(status.uri, idx)
+
+        elif path.startswith('media/') and path not in kept_paths:
+            try:
+                os.remove(f"{data_dir}/{path}")
+                log.info(f"  {path} is not used by {status.uri} anymore; deleted")
+            except FileNotFoundError:
+                pass
+
+
+def get_unchanged_attachment(att, idx, saved_attachments):
+    """Find an attachment in saved_attachments, if it is still the same and was saved"""
+
+    saved = saved_attachments.get(str(att['id']))
+    if not saved:
+        return None
+    if saved['url'] != att['url'] or saved['remote_url'] != att['remote_url']:
+        return None
+
+    path = saved['entry'][0]
+    if path == media.PENDING and saved['idx'] == idx:
+        # still in the pending_media table (which is keyed by idx)
+        return saved
+    if path.startswith('media/') and os.path.isfile(f"{PREFS['user_dir']}/data/{path}"):
+        return saved
+    return None
+
+
+def collect_attachments(attachments):
+    """Wait for the attachments queued by save_attachments() to be downloaded
+
+    Returns the JSON value for the 'attachments' column (or None)
+    """
+
+    r = []
+    for future in attachments:
+        try:
+            r.append(future.result()[:2])
+        except Exception as e:
+            error_msg = f"{type(e).__name__}: {str(e)}"
+            log.err(f"  ❌ Failed to download attachment: {error_msg}", also_print=True)
+            r.append([utils.to_json([error_msg]), ""])
+    return utils.to_json(r) if r else None
+
+
+def collect_media(attachments):
+    """Same as collect_attachments(), for the 'media' table: JSON array of [idx, blob, path]"""
+
+    r = []
+    for idx, future in enumerate(attachments):
+        if future.exception() is None:
+            path, desc, blob = future.result()
+            if blob:
+                r.append([idx, blob, path])
+    return utils.to_json(r)
+
+
 def save_attachment(att, idx, status):
+    ok, txt, blob = download_attachment(get_attachment_urls(att), get_attachment_path(status, idx), status.uri, idx)
+
+    desc = att['description'] if att['description'] else ""
+
+    return [txt, desc, blob]
+
+
+def get_attachment_urls(att):
     urls = []
     if att['url']:
         urls.append(att['url'])
     if att['remote_url']:
         urls.append(att['remote_url'])
+    return urls
+
+
+def get_attachment_path(status, idx):
+    """Where to save an attachment (relative to the data folder, without extension)"""
+
+    id = status.id
+    instance = utils.get_instance(status.uri, True)
+    author = utils.get_username(status.account.uri, True)
+    created_year = status.created_at.year
+    created_month = status.created_at.strftime("%m")
 
-    dl_ok = False
+    # the file extension is added by fetch_file(), as some URL schemes don't include it
+    return f"media/{instance}/{author}/{created_year}/{created_month}/{author}_{id}_{idx:02d}"
+
+
+def download_attachment(urls, path, post_uri, idx):
+    """Download an attachment, trying each of its URLs in turn
+
+    Returns (True, path of the file relative to the data folder, blob or None),
+    or (False, error messages as JSON, None); the blob (see blobs.py) is only
+    recorded by the caller, along with the path
+    """
 
     errors = []
 
     for i, url in enumerate(urls):
         log.info(f"  save_attachment, attempt {i+1} - {url}")
 
-        id = status.id
-        instance = utils.get_instance(status.uri, True)
-        author = utils.get_username(status.account.uri, True)
-        created_year = status.created_at.year
-        created_month = status.created_at.strftime("%m")
-
-        # we will guess the file extension after the file has been downloaded,
-        # as some URL schemes don't include it
-        local_path = f"{PREFS['user_dir']}/data/media/{instance}/{author}/{created_year}/{created_month}/{author}_{id}_{idx:02d}"
-
+        local_path = f"{PREFS['user_dir']}/data/{path}"
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        ok, txt = fetch_file(url, local_path)
+        ok, txt, checksum = fetch_file(url, local_path)
 
         if ok:
-            ext = utils.guess_file_extension(local_path)
-            txt = f"{txt}.{ext}"
-            dl_ok = True
-
-            try:
-                os.rename(local_path, txt)
-            except FileExistsError as e:
-                error_msg = f"{e.code}: {e.reason}"
-                log.err(f"    ❌ Failed to rename '{local_path}' to '{txt}': {error_msg}", True)
-            except Exception as e:
-                error_msg = f"{type(e).__name__}: {str(e)}"
-                log.err(f"    ❌ Failed to rename '{local_path}' to '{txt}': {error_msg}", True)
-            finally:
-                # make the path relative to the database
-                txt = txt.replace(f"{PREFS['user_dir']}/data/", '')
-                break
+            # make the path relative to the database
+            path = txt.replace(f"{PREFS['user_dir']}/data/", '')
+
+            blob = None
+            if PREFS['media_dedupe']:
+                try:
+                    blob = blobs.store(txt, checksum)
+                except Exception as e:
+                    error_msg = f"{type(e).__name__}: {str(e)}"
+                    log.err(f"    ❌ Failed to add '{txt}' to the blob store: {error_msg}", also_print=True)
+
+            return (True, path, blob)
         else:
             errors.append(txt)
 
-    if not dl_ok:
-        log.err(f"  ❌ Failed to download attachment (post: {status.uri})", True)
-        txt = utils.to_json(errors)
-        for err in errors:
-            print(f"    {err})")
-
-    desc = att['description'] if att['description'] else ""
-
-    return [txt, desc]
-
-
-def fetch_file(url, local_path):
-        try:
-            urllib.request.urlretrieve(url, local_path)
-            log.info(f"    OK, saved as {local_path}")
-            return (True, local_path)
-
-        except urllib.error.HTTPError as e:
-            error_msg = f"HTTP {e.code}: {e.reason}"
-            log.err(f"    Failed to download {url}: {error_msg}")
-            return (False, error_msg)
-
-        except urllib.error.URLError as e:
-            error_msg = f"URL Error: {e.reason}"
-            log.err(f"    Failed to download {url}: {error_msg}")
-            return (False, error_msg)
-
-        except Exception as e:
-            error_msg = f"{type(e).__name__}: {str(e)}"
-            log.err(f"    Failed to download {url}: {error_msg}")
-            return (False, error_msg)
-
+    log.err(f"  ❌ Failed to download attachment (post: {post_uri})", also_print=True)
+    for err in errors:
+        print(f"    {err})")
+
+    return (False, utils.to_json(errors), None)
+
+
+def fetch_file(url, local_path, retry=True):
+    """Download a file, streaming it to disk
+
+    The file is first written to a ".part" file, which is kept if the download
+    is interrupted so that it can be resumed (HTTP Range) on the next attempt.
+    The file type is guessed from the first chunk (and the Content-Type header),
+    and the SHA-256 of the file is computed along the way.
+
+    Returns (True, final_path, checksum) or (False, error_message, None)
+    """
+
+    # one .part file per source URL, so that we never resume with a different file
+    part = f"{local_path}.{hashlib.sha1(url.encode()).hexdigest()[:8]}.part"
+    max_size = PREFS['download_max_size'] * 1024**2
+
+    try:
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+        request = urllib.request.Request(url, headers=headers)
+
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+            if offset and response.status != 206:
+                # the server ignored our Range header; start over
+                offset = 0
+
+            length = response.headers.get('Content-Length')
+            if max_size and length and offset + int(length) > max_size:
+                raise DownloadTooLarge(f"{offset + int(length)} bytes (download_max_size is {PREFS['download_max_size']} MB)")
+
+            checksum = hashlib.sha256()
+            head = b''
+            size = offset
+
+            if offset:
+                log.info(f"    Resuming download at {offset} bytes")
+                with open(part, 'rb') as f:
+                    while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+                        head = head or chunk
+                        checksum.update(chunk)
+
+            with open(part, 'ab' if offset else 'wb') as f:
+                while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                    head = head or chunk
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise DownloadTooLarge(f"more than {PREFS['download_max_size']} MB")
+                    checksum.update(chunk)
+                    f.write(chunk)
+
+            content_type = response.headers.get_content_type()
+
+        ext = utils.guess_file_extension(head, content_type)
+        final_path = f"{local_path}.{ext}"
+        os.replace(part, final_path)
+
+        log.info(f"    OK, saved as {final_path} ({size} bytes, sha256 {checksum.hexdigest()})")
+        return (True, final_path, checksum.hexdigest())
+
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and retry:
+            # our .part file doesn't match the remote file any more
+            os.remove(part)
+            return fetch_file(url, local_path, False)
+        error_msg = f"HTTP {e.code}: {e.reason}"
+        log.err(f"    Failed to download {url}: {error_msg}")
+        return (False, error_msg, None)
+
+    except urllib.error.URLError as e:
+        error_msg = f"URL Error: {e.reason}"
+        log.err(f"    Failed to download {url}: {error_msg}")
+        return (False, error_msg, None)
+
+    except DownloadTooLarge as e:
+        if os.path.isfile(part):
+            os.remove(part)
+        error_msg = f"File too large: {e}"
+        log.err(f"    Failed to download {url}: {error_msg}")
+        return (False, error_msg, None)
+
+    except Exception as e:
+        error_msg = f"{type(e).__name__}: {str(e)}"
+        log.err(f"    Failed to download {url}: {error_msg}")
+        return (False, error_msg, None)
@@ -1,7 +1,9 @@
 import re
 import json
+import html.entities
+import mimetypes
 import filetype
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 
 
 def get_account_handle(account, safe=False):
@@ -80,6 +82,19 @@ def post_is_mine(account, status_author_uri):
     return True if account['handle'] == get_handle(status_author_uri) else False
 
 
+# links to Mastodon posts; group 1: instance, group 2: post id
+MASTODON_POST_PATTERN = re.compile(r'https?://([^/]+)/(?:@[^/]+/|users/[^/]+/statuses/|web/statuses/)(\d+)')
+
+# parse_content() gives the same results as BeautifulSoup ('html.parser'),
+# which we used before: these are the rules it follows
+HTML_VOID_ELEMENTS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr'}
+HTML_HIDDEN_ELEMENTS = {'rt', 'rp', 'script', 'style', 'template'}     # their text is not part of the content
+HTML_PRE_ELEMENTS = {'pre', 'textarea'}                                 # whitespace is kept as is
+HTML_SPACES = ' \n\t\x0c\r'
+HTML_ENTITIES = {name.rstrip(';'): char for name, char in html.entities.html5.items()}
+HTML_LINE_BREAKS = [('<br>', '\n'), ('<br/>', '\n'), ('<br />', '\n'), ('</p><p>', '\n\n')]
+
+
 def is_link_mastodon_post(url):
     """Detect if a URL is a link to a Mastodon post.
 
@@ -88,64 +103,312 @@ def is_link_mastodon_post(url):
     - https://instance.com/users/username/statuses/1234567890
     - https://instance.com/web/statuses/1234567890
     """
-    mastodon_post_patterns = [
-        r'https?://[^/]+/@[^/]+/\d+',
-        r'https?://[^/]+/users/[^/]+/statuses/\d+',
-        r'https?://[^/]+/web/statuses/\d+',
-    ]
 
-    for pattern in mastodon_post_patterns:
-        if re.match(pattern, url):
-            return True
+    return MASTODON_POST_PATTERN.match(url) is not None
 
-    return False
 
+def get_post_url_key(url):
+    """Same key for all the forms of a link to the same Mastodon post
 
-def strip_html(html):
-    html = html.replace("<br>", "\n")
-    html = html.replace("<br/>", "\n")
-    html = html.replace("<br />", "\n")
-    html = html.replace("</p><p>", "\n\n")
+    E.g. "instance.com/1234567890" for the three patterns above; None if
+    the URL doesn't look like a link to a Mastodon post.
+    """
 
-    soup = BeautifulSoup(html, 'html.parser')
-    return soup.get_text()
+    match = MASTODON_POST_PATTERN.match(url)
+    if match:
+        return f"{match.group(1).lower()}/{match.group(2)}"
 
+    return None
 
-def extract_links(html):
-    """Extract links from HTML content."""
 
-    if not html:
-        return []
+def parse_content(html):
+    """Plain text and links of the HTML content of a post, in a single pass
+
+    Returns (text, links). The text is the content without the tags, with
+    "<br>" as a line break and "</p><p>" as an empty line; links are the
+    <a href> of the content, without mentions and hashtags:
+    [{'url': ..., 'text': ..., 'mastodon': 0|1}, ...]
+    """
 
-    soup = BeautifulSoup(html, 'html.parser')
-    links = []
+    if not html:
+        return '', []
+
+    parser = _ContentParser()
+    parser.feed(html)
+    parser.close()
+    text, links = parser.result()
+
+    if parser.line_breaks != sum(html.count(tag) for tag, _ in HTML_LINE_BREAKS):
+        # some of them are not tags (e.g. in an attribute or a comment), so
+        # the text view may differ; it is parsed again, as it used to be
+        parser = _ContentParser()
+        parser.feed(replace_line_breaks(html))
+        parser.close()
+        text, _ = parser.result()
+
+    return text, links
+
+
+def replace_line_breaks(html):
+    for tag, text in HTML_LINE_BREAKS:
+        html = html.replace(tag, text)
+    return html
+
+
+class _ContentView:
+    """Tags and text of the content, as seen by one of the two outputs"""
+
+    def __init__(self):
+        self.stack = []         # open tags: (name, link or None)
+        self.closed = []        # void elements already closed, whose end tag is ignored
+        self.data = []
+        self.hidden = 0
+        self.pre = 0
+
+    def push(self, name, link=None):
+        self.stack.append((name, link))
+        if name in HTML_HIDDEN_ELEMENTS:
+            self.hidden += 1
+        if name in HTML_PRE_ELEMENTS:
+            self.pre += 1
+
+    def pop_to(self, name):
+        """Close the most recent tag with this name, and the ones it contains"""
+
+        popped = []
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == name:
+                popped = self.stack[i:]
+                del self.stack[i:]
+                break
+
+        for tag, _ in popped:
+            if tag in HTML_HIDDEN_ELEMENTS:
+                self.hidden -= 1
+            if tag in HTML_PRE_ELEMENTS:
+                self.pre -= 1
+        return popped
+
+    def end_data(self, cdata=False):
+        """The string collected since the last tag; None if it is not part of the text"""
+
+        if not self.data:
+            return None
+
+        string = ''.join(self.data)
+        self.data = []
+
+        if not self.pre and not string.strip(HTML_SPACES):
+            string = '\n' if '\n' in string else ' '
+        if self.hidden and not cdata:
+            return None
+        return string
+
+
+class _ContentParser(HTMLParser):
+    """Builds the two outputs of parse_content() while parsing
+
+    The text is what BeautifulSoup's get_text() returned once "<br>" and
+    "</p><p>" were replaced with line breaks (the text view doesn't see these
+    tags), and the links what find_all('a', href=True) returned on the
+    original content (the link view sees all the tags).
+    """
 
-    for link in soup.find_all('a', href=True):
-        url = link['href']
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.text_view = _ContentView()
+        self.link_view = _ContentView()
+        self.text = []
+        self.links = []
+        self.anchors = []       # links still open: their text is not complete
+        self.tag_pos = -1
+        self.skip_pos = -1
+        self.line_breaks = 0    # number of line break tags seen by the text view
+
+    def parse_starttag(self, i):
+        self.tag_pos = i
+        return super().parse_starttag(i)
+
+    def parse_endtag(self, i):
+        self.tag_pos = i
+        return super().parse_endtag(i)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'br' and self.rawdata.startswith('<br>', self.tag_pos):
+            self.line_break('\n')
+        elif self.tag_pos != self.skip_pos:
+            self.start_tag(self.text_view, tag)
+        self.start_tag(self.link_view, tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == 'br' and self.rawdata.startswith(('<br/>', '<br />'), self.tag_pos):
+            self.line_break('\n')
+        else:
+            self.start_tag(self.text_view, tag, void=False)
+            self.end_tag(self.text_view, tag, void=False)
+        self.start_tag(self.link_view, tag, attrs, void=False)
+        self.end_tag(self.link_view, tag, void=False)
+
+    def handle_endtag(self, tag):
+        if tag == 'p' and self.rawdata.startswith('</p><p>', self.tag_pos):
+            # the next tag (<p>) is skipped too
+            self.line_break('\n\n')
+            self.skip_pos = self.tag_pos + 4
+        else:
+            self.end_tag(self.text_view, tag)
+        self.end_tag(self.link_view, tag)
+
+    def handle_data(self, data):
+        self.add_data(data)
+
+    def handle_entityref(self, name):
+        self.add_data(HTML_ENTITIES.get(name, '&' + name))
+
+    def handle_charref(self, name):
+        if name[:1] in ('x', 'X'):
+            base, digits, pattern = 16, name[1:], '([0-9a-f]+)(.*)'
+        else:
+            base, digits, pattern = 10, name, '([0-9]+)(.*)'
+
+        try:
+            number, rest = int(digits, base), ''
+        except ValueError:
+            match = re.match(pattern, digits)
+            if match is None:
+                self.add_data('')
+                self.add_data(digits)
+                return
+            number, rest = int(match.group(1), base), match.group(2)
+
+        self.add_data(decode_charref(number))
+        self.add_data(rest)
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, decl):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith('CDATA['):
+            self.add_data(data[6:])
+            self.end_data(cdata=True)
+
+    def close(self):
+        super().close()
+        self.end_data()
+        for link in list(self.anchors):
+            self.close_link(link)
+
+    def result(self):
+        return ''.join(self.text), self.links
+
+    def line_break(self, text):
+        self.text_view.data.append(text)
+        self.line_breaks += 1
+
+    def add_data(self, data):
+        if '<' in data:
+            # e.g. in a <script>: for the text view, they were replaced too
+            self.line_breaks += sum(data.count(tag) for tag, _ in HTML_LINE_BREAKS)
+            data_text = replace_line_breaks(data)
+        else:
+            data_text = data
+        self.text_view.data.append(data_text)
+        self.link_view.data.append(data)
+
+    def end_data(self, cdata=False):
+        self.end_text(cdata)
+        self.end_link_text(cdata)
+
+    def end_text(self, cdata=False):
+        string = self.text_view.end_data(cdata)
+        if string is not None:
+            self.text.append(string)
+
+    def end_link_text(self, cdata=False):
+        string = self.link_view.end_data(cdata)
+        if string is not None and self.anchors:
+            string = string.strip()
+            if string:
+                for link in self.anchors:
+                    link['text'].append(string)
+
+    def start_tag(self, view, tag, attrs=None, void=True):
+        if view is self.text_view:
+            self.end_text()
+            view.push(tag)
+        else:
+            self.end_link_text()
+            view.push(tag, self.new_link(tag, attrs))
+
+        if void and tag in HTML_VOID_ELEMENTS:
+            self.end_tag(view, tag, void=False)
+            view.closed.append(tag)
+
+    def end_tag(self, view, tag, void=True):
+        if void and tag in view.closed:
+            view.closed.remove(tag)
+            return
+
+        if view is self.text_view:
+            self.end_text()
+            view.pop_to(tag)
+        else:
+            self.end_link_text()
+            for _, link in view.pop_to(tag):
+                if link is not None:
+                    self.close_link(link)
+
+    def new_link(self, tag, attrs):
+        if tag != 'a':
+            return None
+
+        # the last value wins if an attribute is repeated
+        attrs = dict(attrs)
+        if 'href' not in attrs:
+            return None
+        url = attrs['href'] or ''
 
         # skip hashtags or mentions (class="mention" or class="u-url mention")
-        if 'mention' in link.get('class', []):
-            continue
-        if 'hashtag' in link.get('class', []):
-            continue
-        # if link.get_text(strip=True).startswith('@'):
-        #     continue
-        # if link.get_text(strip=True).startswith('#'):
-        #     continue
-
-        text = link.get_text(strip=True)
-        if text == url:
-            text = ''
-
-        mastodon = 1 if is_link_mastodon_post(url) else 0
-
-        links.append({
+        classes = (attrs.get('class') or '').split()
+        if 'mention' in classes or 'hashtag' in classes:
+            return None
+
+        link = {
             'url': url,
-            'text': text,
-            'mastodon': mastodon
-        })
+            'text': [],
+            'mastodon': 1 if is_link_mastodon_post(url) else 0
+        }
+        self.links.append(link)
+        self.anchors.append(link)
+        return link
+
+    def close_link(self, link):
+        # not remove(): two links can be equal
+        self.anchors = [anchor for anchor in self.anchors if anchor is not link]
+        text = ''.join(link['text'])
+        link['text'] = '' if text == link['url'] else text
+
+
+def decode_charref(number):
+    """Character of a numeric character reference (&#...;), as browsers do"""
 
-    return links
+    if number == 0 or number > 0x10ffff or 0xd800 <= number <= 0xdfff:
+        return '\ufffd'
+
+    if 0x80 <= number <= 0x9f:
+        # control characters: most likely Windows-1252 encoded characters
+        try:
+            return bytes([number]).decode('cp1252')
+        except UnicodeDecodeError:
+            pass
+
+    return chr(number)
 
 
 def extract_tags(tags):
@@ -167,11 +430,21 @@ def extract_poll_options(poll):
         return []
 
 
-def guess_file_extension(path):
-    kind = filetype.guess(path)
-    if kind is None:
-        return 'undefined'
-    return kind.extension
+def guess_file_extension(data, content_type=None):
+    """Guess a file extension from the first bytes of a file
+
+    If the content itself is not recognized, fall back on its MIME type
+    (e.g. the Content-Type header of the response)
+    """
+
+    kind = filetype.guess(data)
+    if kind is not None:
+        return kind.extension
+
+    ext = mimetypes.guess_extension(content_type) if content_type else None
+    if ext:
+        return ext.lstrip('.')
+    return 'undefined'
 
 
 def to_json(data, ind=False):
@@ -180,3 +453,24 @@ def to_json(data, ind=False):
     else:
         return json.dumps(data, default=str, ensure_ascii=False)
 
+
+class Payload:
+    """JSON of a fetched object (status, notification), serialized once
+
+    The compact form is used for the database and the logs; the indented form
+    is only made when a JSON file is written (PREFS['save_json']), from the
+    compact one.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._compact = None
+
+    def compact(self):
+        if self._compact is None:
+            self._compact = to_json(self.data.__dict__)
+        return self._compact
+
+    def indented(self):
+        return json.dumps(json.loads(self.compact()), ensure_ascii=False, indent=4)
+
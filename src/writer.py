@@ -0,0 +1,149 @@
+import atexit
+import queue
+import threading
+
+import src.db as db
+import src.log as log
+
+
+# Single writer for the database.
+#
+# Rows are pushed into a queue (from any thread) and written by one dedicated
+# thread. Everything queued between two flush() calls (typically: all the rows
+# produced by one page of API results) is written in a single transaction.
+#
+# A value in a row can be a callable (e.g. attachments still being downloaded):
+# it is called by the writer thread right before the row is written.
+
+WRITER_BATCH_MAX = 1000     # flush anyway if that many rows are waiting
+
+_queue = queue.Queue()
+_thread = None
+_thread_lock = threading.Lock()
+_last_flush = None
+
+# rows that have been queued but not yet committed, so that db lookups
+# can take them into account: {(table, key): row}
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def start():
+    global _thread
+
+    with _thread_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name='db-writer', daemon=True)
+            _thread.start()
+
+
+def put(table, row):
+    """Queue one row to be written to {table} (see db.WRITES)"""
+
+    start()
+    key = db.WRITES[table]['key'](row)
+    with _pending_lock:
+        _pending[(table, key)] = row
+    _queue.put((table, row))
+
+
+def pending(table, key):
+    """Get a queued (not yet committed) row, or None"""
+
+    with _pending_lock:
+        return _pending.get((table, key))
+
+
+def flush(wait=True):
+    """Write everything queued so far in one transaction
+
+    With wait=False, we only wait for the previous flush to be done (so there
+    is never more than one batch waiting to be written), then return
+    immediately while the writer thread commits this one.
+    """
+
+    global _last_flush
+
+    if _thread is None:
+        return
+
+    if _last_flush is not None:
+        _last_flush.wait()
+
+    done = threading.Event()
+    _last_flush = done
+    _queue.put(('flush', done))
+
+    if wait:
+        done.wait()
+
+
+def stop():
+    """Flush and stop the writer thread (end of run)"""
+
+    global _thread
+
+    with _thread_lock:
+        thread = _thread
+        if thread is None:
+            return
+        done = threading.Event()
+        _queue.put(('stop', done))
+
+    # not holding the lock: other threads (e.g. a download finishing) may
+    # still put() rows, and the writer thread may be waiting for them
+    done.wait()
+    thread.join()
+
+    with _thread_lock:
+        if _thread is thread:
+            _thread = None
+
+    if not _queue.empty():
+        # rows queued after the stop marker
+        start()
+        stop()
+
+
+def _run():
+    batch = []
+
+    while True:
+        kind, item = _queue.get()
+
+        if kind in {'flush', 'stop'}:
+            _write(batch)
+            batch = []
+            item.set()
+            if kind == 'stop':
+                return
+            continue
+
+        batch.append((kind, item))
+        if len(batch) >= WRITER_BATCH_MAX:
+            _write(batch)
+            batch = []
+
+
+def _write(batch):
+    if not batch:
+        return
+
+    for table, row in batch:
+        for k, v in row.items():
+            if callable(v):
+                row[k] = v()
+
+    try:
+        db.write_batch(batch)
+    except Exception as e:
+        log.err(f"❌ Failed to write {len(batch)} rows to the database: {type(e).__name__}: {e}", also_print=True)
+
+    with _pending_lock:
+        for table, row in batch:
+            key = (table, db.WRITES[table]['key'](row))
+            if _pending.get(key) is row:
+                del _pending[key]
+
+
+atexit.register(stop)
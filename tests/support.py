@@ -0,0 +1,104 @@
+"""Test environment: a temporary user folder, fake statuses and a local file server
+
+Import this module before anything from src: src loads "prefs.json" from the
+current directory when it is imported.
+"""
+
+import atexit
+import functools
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix='lama-tests-')
+USER_DIR = f"{TMP}/user"
+WWW_DIR = f"{TMP}/www"
+# registered first, so that it runs after the writer is stopped (see writer.py)
+atexit.register(shutil.rmtree, TMP, ignore_errors=True)
+
+os.makedirs(f"{USER_DIR}/data", exist_ok=True)
+os.makedirs(WWW_DIR, exist_ok=True)
+with open(f"{TMP}/prefs.json", 'w') as f:
+    json.dump({
+        'accounts': [{'username': 'me', 'instance': 'https://example.com'}],
+        'prefs': {'user_dir': USER_DIR, 'save_json': 0, 'log_level': 'warning'},
+    }, f)
+
+sys.path.insert(0, ROOT)
+os.chdir(TMP)
+
+import src                                      # noqa: E402
+from mastodon.return_types import Status        # noqa: E402
+from mastodon.types_base import try_cast_recurse  # noqa: E402
+
+import src.db as db                             # noqa: E402
+import src.download as download                 # noqa: E402
+import src.writer as writer                     # noqa: E402
+
+DEFAULT_PREFS = dict(src.PREFS)
+ACCOUNT = src.ACCOUNTS[0]
+
+
+def reset(**prefs):
+    """Empty database and user folder, default preferences (+ prefs)"""
+
+    download.shutdown()
+    writer.stop()
+    db.close_all()
+    shutil.rmtree(f"{USER_DIR}/data")
+    os.makedirs(f"{USER_DIR}/data")
+
+    src.PREFS.clear()
+    src.PREFS.update(DEFAULT_PREFS, **prefs)
+    db.init_db()
+
+
+def status(id, media=(), edited_at=None, **fields):
+    """A status of ACCOUNT; media: [(attachment id, URL)]"""
+
+    data = {
+        'id': str(id),
+        'uri': f"https://example.com/users/me/statuses/{id}",
+        'url': f"https://example.com/@me/{id}",
+        'created_at': '2024-01-01T00:00:00.000Z',
+        'edited_at': edited_at,
+        'visibility': 'public',
+        'content': '<p>Hello</p>',
+        'account': {'url': 'https://example.com/@me', 'uri': 'https://example.com/users/me'},
+        'tags': [],
+        'mentions': [],
+        'reblog': None,
+        'in_reply_to_id': None,
+        'media_attachments': [
+            {'id': media_id, 'url': url, 'remote_url': None, 'description': f"alt {media_id}", 'type': 'image'}
+            for media_id, url in media
+        ],
+    }
+    data.update(fields)
+    return try_cast_recurse(Status, data)
+
+
+def add_file(name, content):
+    """Serve {content} (bytes) at file_url(name)"""
+
+    with open(f"{WWW_DIR}/{name}", 'wb') as f:
+        f.write(content)
+    return file_url(name)
+
+
+class _Handler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(_Handler, directory=WWW_DIR))
+threading.Thread(target=_server.serve_forever, daemon=True).start()
+
+
+def file_url(name):
+    return f"http://127.0.0.1:{_server.server_address[1]}/{name}"
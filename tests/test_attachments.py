@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import unittest
+
+from tests import support
+
+import src.db as db
+import src.writer as writer
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'first image'
+GIF = b'GIF89a' + b'second image'
+
+
+class EditedAttachmentsTest(unittest.TestCase):
+    """A post saved again after an edit keeps (or deletes) the right files"""
+
+    def setUp(self):
+        self.png = support.add_file('a.png', PNG)
+        self.gif = support.add_file('b.gif', GIF)
+
+    def save(self, media, edited_at=None):
+        db.save_status(support.ACCOUNT, support.status(1, media, edited_at), 'post')
+        writer.flush()
+
+    def get_attachments(self):
+        (con, cur) = db.open_con()
+        cur.execute("SELECT attachments FROM posts")
+        attachments = json.loads(cur.fetchone()[0] or '[]')
+        cur.execute("SELECT idx, path, blob FROM media ORDER BY idx")
+        return attachments, cur.fetchall()
+
+    def read(self, path):
+        with open(f"{support.USER_DIR}/data/{path}", 'rb') as f:
+            return f.read()
+
+    def check_swap(self, media_dedupe):
+        support.reset(download_own_attachments=1, media_dedupe=media_dedupe)
+
+        self.save([('a', self.png), ('b', self.gif)])
+        self.save([('b', self.gif), ('a', self.png)], '2024-02-01T00:00:00.000Z')
+
+        attachments, media = self.get_attachments()
+        self.assertEqual([self.read(path) for path, desc in attachments], [GIF, PNG])
+        self.assertEqual([desc for path, desc in attachments], ['alt b', 'alt a'])
+
+        if media_dedupe:
+            self.assertEqual([(idx, path) for idx, path, blob in media], [(0, attachments[0][0]), (1, attachments[1][0])])
+            for idx, path, blob in media:
+                self.assertTrue(blob.startswith(hashlib.sha256(self.read(path)).hexdigest()))
+        else:
+            self.assertEqual(media, [])
+
+        # nothing left at the previous paths (other extensions)
+        files = sorted(os.listdir(f"{support.USER_DIR}/data/media/examplecom/me/2024/01"))
+        self.assertEqual(files, sorted(os.path.basename(path) for path, desc in attachments))
+
+    def test_swap(self):
+        self.check_swap(media_dedupe=0)
+
+    def test_swap_dedupe(self):
+        self.check_swap(media_dedupe=1)
+
+    def test_swap_in_one_batch(self):
+        # the first version isn't committed yet when the second one is saved
+        support.reset(download_own_attachments=1, media_dedupe=1)
+
+        db.save_status(support.ACCOUNT, support.status(1, [('a', self.png), ('b', self.gif)]), 'post')
+        db.save_status(support.ACCOUNT, support.status(1, [('b', self.gif), ('a', self.png)], '2024-02-01T00:00:00.000Z'), 'post')
+        writer.flush()
+
+        attachments, media = self.get_attachments()
+        self.assertEqual([self.read(path) for path, desc in attachments], [GIF, PNG])
+        self.assertEqual([path for idx, path, blob in media], [path for path, desc in attachments])
+
+    def test_removal(self):
+        support.reset(download_own_attachments=1, media_dedupe=1)
+
+        self.save([('a', self.png), ('b', self.gif)])
+        first, _ = self.get_attachments()
+        self.save([('b', self.gif)], '2024-02-01T00:00:00.000Z')
+
+        attachments, media = self.get_attachments()
+        self.assertEqual([self.read(path) for path, desc in attachments], [GIF])
+        self.assertEqual([(idx, path) for idx, path, blob in media], [(0, attachments[0][0])])
+        for path, desc in first:
+            if path != attachments[0][0]:
+                self.assertFalse(os.path.exists(f"{support.USER_DIR}/data/{path}"))
+
+    def test_removal_pending(self):
+        support.reset(download_own_attachments=1, defer_attachments=1)
+
+        self.save([('a', self.png), ('b', self.gif)])
+        self.save([('a', self.png)], '2024-02-01T00:00:00.000Z')
+
+        (con, cur) = db.open_con()
+        cur.execute("SELECT idx FROM pending_media")
+        self.assertEqual(cur.fetchall(), [(0,)])
+
+    def test_pending_description(self):
+        support.reset(download_own_attachments=1, defer_attachments=1)
+
+        self.save([('a', self.png)])
+        edited = support.status(1, [('a', self.png)], '2024-02-01T00:00:00.000Z')
+        edited.media_attachments[0]['description'] = 'new alt'
+        db.save_status(support.ACCOUNT, edited, 'post')
+        writer.flush()
+
+        (con, cur) = db.open_con()
+        cur.execute("SELECT description FROM pending_media")
+        self.assertEqual(cur.fetchall(), [('new alt',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from tests import support
+
+import src
+import src.bench as bench
+import src.db as db
+
+
+class BenchTest(unittest.TestCase):
+
+    def test_save(self):
+        support.reset()
+        statuses = bench.synthetic_statuses(20)
+
+        for open_con in (bench.open_con_reused, bench.open_con_per_query):
+            with self.subTest(open_con=open_con.__name__):
+                self.assertGreater(bench.measure_save(statuses, open_con), 0)
+                # the database and the preferences of the run are left as they were
+                self.assertEqual(src.PREFS['user_dir'], support.USER_DIR)
+                self.assertIs(db.open_con, bench.open_con_reused)
+
+    def test_synthetic_statuses(self):
+        statuses = bench.synthetic_statuses(3)
+
+        self.assertEqual([status.id for status in statuses], ['1', '2', '3'])
+        self.assertEqual(len({status.uri for status in statuses}), 3)
+        self.assertEqual(statuses[2].account.url, 'https://example.com/@me')
+
+
+if __name__ == '__main__':
+    unittest.main()
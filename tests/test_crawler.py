@@ -0,0 +1,62 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from tests import support
+
+import src.crawler as crawler
+
+ALICE = {'handle': 'alice@example.com'}
+BOB = {'handle': 'bob@example.org'}
+
+
+class FrontierTest(unittest.TestCase):
+
+    def setUp(self):
+        support.reset(crawl_workers=2)
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def process(self, item):
+        time.sleep(0.05)
+        with self.lock:
+            self.processed.append((item[0]['handle'], item[2]))
+
+    def test_run_only_takes_its_account(self):
+        with mock.patch.object(crawler, 'process', self.process):
+            for i in range(3):
+                crawler.push(ALICE, 'link', f"https://a/{i}", 'post.link')
+            crawler.push(BOB, 'link', 'https://b/0', 'post.link')
+
+            crawler.run(BOB)
+            self.assertEqual(self.processed, [('bob@example.org', 'https://b/0')])
+            self.assertEqual(crawler.depth(ALICE), 3)
+
+            crawler.run(ALICE)
+            self.assertEqual(len(self.processed), 4)
+
+    def test_run_waits_for_items_of_another_run(self):
+        with mock.patch.object(crawler, 'process', self.process):
+            for i in range(6):
+                crawler.push(ALICE, 'link', f"https://a/{i}", 'post.link')
+
+            counts = []
+
+            def run():
+                crawler.run(ALICE)
+                with self.lock:
+                    counts.append(len(self.processed))
+
+            threads = [threading.Thread(target=run) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+
+            # neither run returned before all the items were saved
+            self.assertEqual(counts, [6, 6])
+
+
+if __name__ == '__main__':
+    unittest.main()
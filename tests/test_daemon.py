@@ -0,0 +1,106 @@
+import unittest
+from unittest import mock
+
+from mastodon import MastodonNetworkError
+
+from tests import support
+
+import src.daemon as daemon
+import src.db as db
+import src.fetch as f
+
+
+class FakeStream:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeApi:
+    """Streaming API of one account: events are sent with emit()"""
+
+    def __init__(self):
+        self.listener = None
+        self.stream = None
+
+    def stream_user(self, listener, **kwargs):
+        self.listener = listener
+        self.stream = FakeStream()
+        return self.stream
+
+    def emit(self, event, data):
+        getattr(self.listener, f"on_{event}")(data)
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        support.reset(daemon_interval=0)
+        self.api = FakeApi()
+        self.polls = 0
+
+    def run_daemon(self, validate, poll):
+        """Run the daemon until poll() raises KeyboardInterrupt"""
+
+        def fetch_accounts():
+            self.polls += 1
+            poll(self.polls)
+            return {}
+
+        with mock.patch.object(f, 'validate_username', side_effect=validate), \
+                mock.patch.object(f, 'connect_api', return_value=self.api), \
+                mock.patch.object(f, 'fetch_accounts', side_effect=fetch_accounts), \
+                mock.patch.object(f, 'log_summary'), \
+                mock.patch.object(daemon, 'DAEMON_RECONNECT_WAIT', 0.01):
+            daemon.run()
+
+    def count_posts(self):
+        (con, cur) = db.open_con()
+        cur.execute("SELECT COUNT(*) FROM posts")
+        return cur.fetchone()[0]
+
+    def test_streamed_post_is_saved(self):
+        def poll(n):
+            if n == 1:
+                self.api.emit('update', support.status(1))
+                self.api.emit('update', support.status(2, account={'url': 'https://example.net/@other', 'uri': 'https://example.net/users/other'}))
+            else:
+                raise KeyboardInterrupt
+
+        self.run_daemon(lambda account: True, poll)
+
+        # only our own posts are saved from the home timeline
+        self.assertEqual(self.count_posts(), 1)
+        self.assertTrue(self.api.stream.closed)
+
+    def test_unreachable_at_start(self):
+        attempts = []
+
+        def validate(account):
+            attempts.append(account['handle'])
+            if len(attempts) < 3:
+                raise MastodonNetworkError('instance unreachable')
+            return True
+
+        def poll(n):
+            if self.api.listener is not None:
+                raise KeyboardInterrupt
+
+        self.run_daemon(validate, poll)
+        self.assertEqual(len(attempts), 3)
+        self.assertIsNotNone(self.api.stream)
+
+    def test_failed_poll(self):
+        def poll(n):
+            if n < 3:
+                raise MastodonNetworkError('instance unreachable')
+            raise KeyboardInterrupt
+
+        self.run_daemon(lambda account: True, poll)
+        self.assertEqual(self.polls, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
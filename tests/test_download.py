@@ -0,0 +1,27 @@
+import threading
+import unittest
+
+from tests import support
+
+import src.download as download
+
+
+class HostLimitTest(unittest.TestCase):
+
+    def test_other_hosts_not_starved(self):
+        support.reset(download_workers=2, download_per_host=1)
+
+        release = threading.Event()
+        busy = [download.submit(release.wait, 10, url=f"https://busy.example/{i}") for i in range(5)]
+        other = download.submit(lambda: 'done', url='https://other.example/1')
+
+        # the queued downloads of the busy host don't hold the second worker
+        self.assertEqual(other.result(timeout=5), 'done')
+        self.assertEqual(sum(future.running() for future in busy), 1)
+
+        release.set()
+        self.assertTrue(all(future.result(timeout=5) for future in busy))
+
+
+if __name__ == '__main__':
+    unittest.main()
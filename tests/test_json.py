@@ -0,0 +1,30 @@
+import glob
+import gzip
+import unittest
+
+from tests import support
+
+import src.db as db
+import src.pack as pack
+import src.writer as writer
+
+
+class PackedJsonTest(unittest.TestCase):
+
+    def test_saved_once(self):
+        # a post saved again without changes isn't appended again
+        support.reset(save_json=1, json_format='packed')
+
+        for _ in range(3):
+            db.save_status(support.ACCOUNT, support.status(1), 'post')
+            writer.flush()
+        db.save_status(support.ACCOUNT, support.status(1, edited_at='2024-02-01T00:00:00.000Z'), 'post')
+        pack.close()
+
+        [segment] = glob.glob(f"{support.USER_DIR}/data/json/*/posts/2024/01.jsonl.gz")
+        with gzip.open(segment) as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
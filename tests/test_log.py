@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from tests import support
+
+import src
+import src.log as log
+
+
+class LogTest(unittest.TestCase):
+
+    def test_errors_of_the_final_flush_are_logged(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(f"{tmp}/prefs.json", 'w') as f:
+                json.dump({
+                    'accounts': [{'username': 'me', 'instance': 'https://example.com'}],
+                    'prefs': {'user_dir': f"{tmp}/user", 'log_level': 'warning'},
+                }, f)
+
+            # the database doesn't exist: the write fails when the writer
+            # is stopped, at exit
+            script = (
+                "import src.log as log\n"
+                "import src.writer as writer\n"
+                "log.warn('started')\n"
+                "writer.put('posts', {'post_uri': 'x'})\n"
+            )
+            subprocess.run([sys.executable, '-c', script], cwd=tmp, env=dict(os.environ, PYTHONPATH=support.ROOT), check=True, capture_output=True)
+
+            with open(f"{tmp}/user/logs/{log.LOG_PREFIX}.log", encoding='utf-8') as f:
+                self.assertIn("Failed to write 1 rows", f.read())
+
+    def test_purge_legacy_logs(self):
+        support.reset(log_history_limit=2)
+        log.get_logger()
+        logs_dir = f"{src.PREFS['user_dir']}/logs"
+
+        legacy = [f"{log.LOG_PREFIX}-20240101-00000{i}.log" for i in range(4)]
+        for file in legacy + [f"{log.LOG_PREFIX}.log.1"]:
+            with open(f"{logs_dir}/{file}", 'w') as f:
+                f.write('old')
+
+        log.purge_legacy_logs(logs_dir)
+
+        left = sorted(os.listdir(logs_dir))
+        self.assertEqual(left, sorted([f"{log.LOG_PREFIX}.log", f"{log.LOG_PREFIX}.log.1"] + legacy[2:]))
+
+
+if __name__ == '__main__':
+    unittest.main()